@@ -0,0 +1,97 @@
+'''
+Compare the memory used by each item type in the normal and compact modes.
+
+    python benchmark/item_memory.py [items per type]
+
+Items are built from fake data covering every data hint of their class, so
+no Redmine server is needed.  The sizes are the bytes owned by each item
+(the instance, its __dict__, change tracking and sub-managers), not counting
+the field values themselves which are the same in both modes.
+'''
+import os
+import sys
+import gc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from redmine import Redmine
+from redmine.redmine_rest import Redmine_Item, Redmine_Items_Manager
+
+
+def fake_data(item_class, id):
+    '''Return a dict with a value for every data hint of the class.'''
+    data = {}
+    for name in dir(item_class):
+        if name.startswith('_') or getattr(item_class, name) is not None:
+            continue
+        field_type = item_class._field_type.get(name)
+        if field_type == 'datetime':
+            data[name] = '2013-02-07T01:00:28Z'
+        elif field_type == 'date':
+            data[name] = '2013-02-07'
+        elif name == 'roles':
+            data[name] = [{'id': 3, 'name': 'Manager'}]
+        else:
+            data[name] = 'value'
+    data['id'] = id
+    return data
+
+
+def owned_size(item):
+    '''The bytes used by the item itself and its bookkeeping.'''
+    size = sys.getsizeof(item)
+    # Reading item.__dict__ would make one on items that don't have it yet,
+    # so look for it among what the instance refers to instead
+    attributes = None
+    if type(item).__dictoffset__:
+        slot_values = set()
+        for cls in type(item).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                try:
+                    slot_values.add(id(cls.__dict__[name].__get__(item, cls)))
+                except (AttributeError, KeyError):
+                    pass
+        for referent in gc.get_referents(item):
+            if isinstance(referent, dict) and id(referent) not in slot_values:
+                attributes = referent
+                break
+    if attributes is not None:
+        size += sys.getsizeof(attributes)
+        for value in attributes.values():
+            if isinstance(value, Redmine_Items_Manager):
+                size += sys.getsizeof(value) + sys.getsizeof(value.__dict__)
+    if item._changes is not None:
+        size += sys.getsizeof(item._changes)
+    return size
+
+
+def measure(item_class, count, compact):
+    redmine = Redmine('http://no-route.none', compact=compact)
+    items = [redmine.check_cache(item_class._get_type(),
+                                 fake_data(item_class, id), item_class)
+             for id in xrange(1, count + 1)]
+    size = sum(owned_size(item) for item in items)
+    return size / float(count)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    redmine = Redmine('http://no-route.none')
+    classes = sorted(set(redmine.item_class.values()),
+                     key=lambda cls: cls.__name__)
+
+    print '%-22s %10s %10s %8s' % ('item type', 'normal', 'compact', 'saved')
+    for item_class in classes:
+        if item_class is Redmine_Item:
+            continue
+        gc.collect()
+        normal = measure(item_class, count, False)
+        gc.collect()
+        compact = measure(item_class, count, True)
+        print '%-22s %9.0fB %9.0fB %7.0f%%' % (
+            item_class.__name__, normal, compact,
+            100 * (normal - compact) / normal)
+
+
+if __name__ == '__main__':
+    main()
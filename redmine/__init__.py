@@ -251,32 +251,40 @@ If you examine your issue object, you'll see that it contains an author paramete
    >>> issue.author
    <Redmine user #5 - Ian Epperson>
 
-However, this user object is incomplete:
+However, this user object is incomplete, it only holds the id and name the issue gave.  pyRedmine marks
+objects like this (and those returned by a query, which only hold a summary) as partial.  The first time you read a
+field that a partial object doesn't have, its full details are fetched (works on Redmine 1.1 and later where this
+data is available).  Partial objects from the same page of a query are fetched together.  This happens at most
+once per object, and not for fields the server sent as empty, data only sent with include= (such as issue.children)
+or for printing the object.
 
 ::
 
    >>> issue.author.last_login
-   
-   >>>
+   datetime.datetime(2013, 2, 7, 1, 0, 28, tzinfo=tzutc())
 
-pyRedmine created the object with the data it had on hand, and since it doesn't have the last_login data (it wasn't
-in the issue information) it isn't shown here.  There are two ways to flesh out that data, one is to use the refresh
-method for the author (works on Redmine 1.1 and later where this data is available).
+You can also simply request that user id from the server
 
 ::
 
-   >>> issue.author.refresh()
-   >>> issue.author.last_login
-   datetime.datetime(2013, 2, 7, 1, 0, 28, tzinfo=tzutc())
-   
-The other is to simply request that user id from the server
+   >>> demo.users[5]
+   <Redmine user #5 - Ian Epperson>
+
+To pick up changes made on the server since an object was read, use its refresh method.  The server only sends the
+object again if it changed, and with max_age (in seconds) nothing is asked at all if it was read recently.  Unsaved
+changes are kept, refresh doesn't save them.
 
 ::
 
-   >>> demo.users[5]
-   <Redmine user #5 - Ian Epperson>
-   >>> issue.author.last_login
-   datetime.datetime(2013, 2, 7, 1, 0, 28, tzinfo=tzutc())
+   >>> issue.refresh(max_age=60)
+
+To make sure a save doesn't overwrite someone else's changes, save with check_conflicts.  If the object changed on the
+server since it was read, RedmineConflictError is raised and nothing is saved.
+
+::
+
+   >>> issue.subject = 'Fix the frobnicator'
+   >>> issue.save(check_conflicts=True)
 
 pyRedmine caches all objects it sees and sets up all cross references.  Updating a Redmine object attached to one object 
 will update them all.  Also, this allows you to directly compare objects if needed:
@@ -290,7 +298,7 @@ Change an Issue's Status
 ++++++++++++++++++++++++
 
 You can move an issue through the workflow as well.  You must set an issue status based on the status ID,
-which is can only be discovered in Redmine version 2.2 and later (but not yet available via this library).
+which is can only be discovered in Redmine version 2.2 and later.
 By default, the library uses the status ID for Resolved and Closed from a default Redmine installation, 
 but if you've changed them in the Administration page, you'll have to change these each time as well.
 
@@ -318,6 +326,18 @@ If you need to set another status, you'll need to find the requisite status ID,
 
    >>> issue.set_status(8, 'Setting the status from Python!')
 
+On Redmine 1.3 and later the status can also be given by name.  The statuses, priorities, trackers and time entry
+activities are loaded from the server the first time one is needed, and can be looked up through the enumerations
+attribute on the Redmine server object:
+
+::
+
+   >>> issue.set_status('Feedback', 'Setting the status from Python!')
+   >>> demo.enumerations.id('status', 'Feedback')
+   4
+   >>> demo.enumerations.name('priority', 2)
+   u'Normal'
+
 If you need to close an issue and don't need to get an issue object, you can set the issue status directly
 using the Redmine server object with a single operation:
 
@@ -408,4 +428,4 @@ Not every item supports every method.  For instance, no current version of Redmi
 
 __all__ = []
 
-from redmine import Redmine
+from redmine import Redmine, Bulk_Create_Error, RedmineConflictError, Field
@@ -0,0 +1,167 @@
+# PyRedmineWS - Python Redmine Web Services
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Streams whole collections of items from the server to files.
+
+import os
+import csv
+import json
+
+from redmine_rest import _raw_getter, _index_key
+
+
+class Exporter(object):
+    '''Writes every item of some types to files, one file per type:
+
+    >>> exporter = Exporter(server, '/backups/redmine')
+    >>> exporter.run('projects', 'issues', 'time_entries')
+    {'projects': 12, 'issues': 5402, 'time_entries': 20311}
+
+    Each type is named as its manager on the Redmine object, and written to
+    <directory>/<name>.jsonl (the item data as the server sent it, one item
+    per line) or, with format='csv', to <name>.csv with one column per field
+    (fields that refer to other items give their id).
+
+    Items are written a page at a time as they arrive, without being kept,
+    so memory use doesn't grow with the number of items.  After each page, a
+    checkpoint is saved (in <directory>/export_checkpoint.json unless given),
+    and running the same export again carries on from there instead of
+    starting over.  Types that were finished are skipped, so remove the
+    checkpoint file to export everything again.'''
+
+    def __init__(self, redmine, directory, format='jsonl', checkpoint=None,
+                 limit=100):
+        if format not in ('jsonl', 'csv'):
+            raise ValueError('Unknown export format %r.' % format)
+        self._redmine = redmine
+        self.directory = directory
+        self.format = format
+        self.checkpoint_path = checkpoint or os.path.join(
+            directory, 'export_checkpoint.json')
+        # Items per request
+        self.limit = limit
+        self.checkpoint = self._load_checkpoint()
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                return json.load(checkpoint_file)
+        except IOError:
+            return {}
+
+    def _save_checkpoint(self):
+        '''Replace the checkpoint file, so it is never left half written.'''
+        temporary = self.checkpoint_path + '.tmp'
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump(self.checkpoint, checkpoint_file)
+        os.rename(temporary, self.checkpoint_path)
+
+    def run(self, *names, **options):
+        '''Export the given types, returns {name: items written}.
+        Any options are passed to each query.'''
+        return dict((name, self.export(name, **options)) for name in names)
+
+    def export(self, name, fields=None, **options):
+        '''Export one type, returns how many of its items have been written.
+
+        fields are the CSV columns, all the fields of the item class if
+        not given.  Any other options are passed to the query.'''
+        manager = getattr(self._redmine, name)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        progress = self.checkpoint.get(name)
+        if progress and progress['done']:
+            return progress['count']
+        if progress is None:
+            progress = {'offset': 0, 'count': 0, 'size': 0, 'last_id': None,
+                        'ascending': True, 'done': False}
+
+        # Everything, not just what the server lists by default
+        # (ie: closed issues too), in a stable order
+        item_class = manager._object
+        for option in item_class._default_filters:
+            options.setdefault(option, '*')
+        options.setdefault('sort', 'id')
+        options['limit'] = self.limit
+
+        path = os.path.join(self.directory, '%s.%s' % (name, self.format))
+        output = open(path, 'ab' if progress['size'] else 'wb')
+        try:
+            # Drop anything written after the last checkpoint
+            output.truncate(progress['size'])
+            output.seek(progress['size'])
+            writer = self._writer(output, item_class, fields,
+                                  header=not progress['size'])
+
+            offset = progress['offset']
+            for data_container in manager._pages(options, offset=offset):
+                for entry in data_container:
+                    id = entry.get('id')
+                    if progress['ascending'] and progress['last_id'] is not None:
+                        if id is not None and id <= progress['last_id']:
+                            # Already written, the list moved up since
+                            continue
+                    writer(entry)
+                    progress['count'] += 1
+                    if id is not None:
+                        if progress['last_id'] is not None and \
+                                id < progress['last_id']:
+                            progress['ascending'] = False
+                        progress['last_id'] = id
+                offset += len(data_container)
+                output.flush()
+                progress['offset'] = offset
+                progress['size'] = output.tell()
+                self.checkpoint[name] = progress
+                self._save_checkpoint()
+        finally:
+            output.close()
+
+        progress['done'] = True
+        self.checkpoint[name] = progress
+        self._save_checkpoint()
+        return progress['count']
+
+    def _writer(self, output, item_class, fields, header):
+        '''Returns a function writing one item's data to the output.'''
+        if self.format == 'jsonl':
+            def write_line(entry):
+                output.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            return write_line
+
+        if fields is None:
+            fields = ['id'] + sorted(field for field in item_class._schema.fields
+                                     if field != 'id')
+        getters = [_raw_getter(field) for field in fields]
+        writer = csv.writer(output)
+        if header:
+            writer.writerow(fields)
+
+        def write_row(entry):
+            writer.writerow([_csv_value(get(entry)) for get in getters])
+        return write_row
+
+
+def _csv_value(value):
+    '''Returns a value as written in a CSV column.'''
+    if value is None:
+        return ''
+    if isinstance(value, dict):
+        return _index_key(value)
+    if isinstance(value, list):
+        return json.dumps(value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
@@ -14,7 +14,8 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from redmine_rest import Redmine_Item, Redmine_Items_Manager, Redmine_WS
-from redmine_rest import RedmineError
+from redmine_rest import RedmineError, RedmineConflictError, Bulk_Create_Error, Sub_Manager
+from redmine_rest import Field
 
 # To create a new item to be tracked from Redmine, create a class for that item
 # based on the Redmine_Item class. The class name must be identical to the name
@@ -46,6 +47,16 @@ from redmine_rest import RedmineError
 # a dictionary containing an 'id' key or an object with an 'id' attribute)
 # the id will be extracted and sent via the 'category_id' field.
 
+# _field_type gives the type of fields that aren't plain values: 'date',
+# 'datetime', 'float', 'int', or the name of the item type the field
+# refers to (ie: 'assigned_to': 'user').
+
+# _include_only lists the fields only sent when asked for with include=,
+# which reading an item that came from a query doesn't fetch.
+
+# _protected_attr, _remap_to_id, _field_type and _include_only are read
+# once, when the class is defined, into the class _schema.
+
 # In order to get data from and set data to the server,
 # the Redmine_Items_Manager looks for specific fields within the item class to
 # tell it which path to use. Also, information coming back from queries is
@@ -62,10 +73,21 @@ from redmine_rest import RedmineError
 #                                  # save it back.
 #  _item_new_path = '/items.json'  # Where to put new item info.
 #                                  # Often the same as the _query_path.
+#  _batch_filter = 'item_id'       # Query filter taking many ids at once
+#                                  # (item_id=1,2,3) if there is one.
+
+# Items that own other items (such as the issues of a project) declare a
+# Sub_Manager for them, which is only created the first time it's used.
+#
+#  issues = Sub_Manager('Issue',
+#                       scope='project_id',
+#                       query_path='/projects/{id}/issues.json',
+#                       item_new_path='/projects/{id}/issues.json')
 
 # By default, the __str__ just returns the item's name.  If there's a better
 # representation of the item, then it's a good idea to override this
-# and provide it.
+# and provide it.  Read the fields with self._peek('name') there, so
+# printing an item never fetches anything from the server.
 # __int__ will provide the ID.
 
 
@@ -101,45 +123,51 @@ class Project(Redmine_Item):
     _item_path = '/projects/%s.json'
     _item_new_path = '/projects.json'
 
-    def __init__(self, redmine, *args, **kw_args):
-        # Override init to also set up sub-queries
-        # Call the base-class init
-        super(Project, self).__init__(redmine, *args, **kw_args)
-
-        # Manage issues for this project,
-        # using __dict__ to bypass the changes__dict__
-        # Bake this project ID into queries and new issue commands
-        self._add_item_manager(
-            'issues', Issue,
-            query_path='/projects/{id}/issues.json',
-            item_new_path='/projects/{id}/issues.json')
-
-        # Manage time entries for this project
-        self._add_item_manager(
-            'time_entries', Time_Entry,
-            query_path='/projects/{id}/time_entries.json',
-            item_new_path='/projects/{id}/time_entries.json')
-
-        # Manage wiki pages if they're available
-        if redmine.has_wiki_pages:
-            self.__dict__['wiki_pages'] = \
-                Redmine_Wiki_Pages_Manager(redmine, self)
-
-        if redmine.has_project_memberships:
-            self._add_item_manager(
-                'members', Membership,
-                query_path='/projects/{id}/memberships.json',
-                item_new_path='/projects/{id}/memberships.json')
-
-        if redmine.has_project_versions:
-            self._add_item_manager(
-                'versions', Version,
-                query_path='/projects/{id}/versions.json',
-                item_new_path='/projects/{id}/versions.json')
+    # Manage issues for this project,
+    # Bake this project ID into queries and new issue commands
+    issues = Sub_Manager(
+        'Issue',
+        scope='project_id',
+        query_path='/projects/{id}/issues.json',
+        item_new_path='/projects/{id}/issues.json')
+
+    # Manage time entries for this project
+    time_entries = Sub_Manager(
+        'Time_Entry',
+        scope='project_id',
+        query_path='/projects/{id}/time_entries.json',
+        item_new_path='/projects/{id}/time_entries.json')
+
+    # Manage wiki pages if they're available
+    wiki_pages = Sub_Manager(
+        factory=lambda project: Redmine_Wiki_Pages_Manager(project._redmine,
+                                                           project),
+        available='has_wiki_pages')
+
+    members = Sub_Manager(
+        'Membership',
+        available='has_project_memberships',
+        scope='project_id',
+        query_path='/projects/{id}/memberships.json',
+        item_new_path='/projects/{id}/memberships.json')
+
+    versions = Sub_Manager(
+        'Version',
+        available='has_project_versions',
+        query_path='/projects/{id}/versions.json',
+        item_new_path='/projects/{id}/versions.json')
+
+    issue_categories = Sub_Manager(
+        'Issue_Category',
+        available='has_issue_categories',
+        scope='project_id',
+        query_path='/projects/{id}/issue_categories.json',
+        item_new_path='/projects/{id}/issue_categories.json')
 
 
     def __repr__(self):
-        return '<Redmine project #%s "%s">' % (self.id, self.identifier)
+        return '<Redmine project #%s "%s">' % (self.id,
+                                               self._peek('identifier'))
 
 
 class Tracker(Redmine_Item):
@@ -170,7 +198,7 @@ class Tracker(Redmine_Item):
         super(Tracker, self).__init__(redmine, *args, **kw_args)
 
     def __str__(self):
-        return '<Redmine tracker #%s, "%s">' % (self.id, self.name)
+        return '<Redmine tracker #%s, "%s">' % (self.id, self._peek('name'))
 
 
 class Issue(Redmine_Item):
@@ -202,9 +230,23 @@ class Issue(Redmine_Item):
         'updated_on': 'datetime',
         'start_date': 'date',
         'due_date': 'date',
-        'fixed_version': 'version'
+        'estimated_hours': 'float',
+        'done_ratio': 'int',
+        'fixed_version': 'version',
+        # Only sent when asked for with include=
+        'children': 'issue',
+        'relations': 'issue_relation',
+        'attachments': 'attachment',
+        'watchers': 'user',
     }
 
+    _include_only = ['journals',
+                     'children',
+                     'relations',
+                     'attachments',
+                     'watchers',
+                     ]
+
     # these fields will map from tag to tag_id when saving the issue.
     # for instance, redmine needs the category_id=#, not the category as given
     # the logic will attempt to grab category['id'] to set category_id
@@ -212,6 +254,8 @@ class Issue(Redmine_Item):
                     'project',
                     'category',
                     'status',
+                    'priority',
+                    'tracker',
                     'parent_issue',
                     'fixed_version']
 
@@ -221,58 +265,112 @@ class Issue(Redmine_Item):
     _item_path = '/issues/%s.json'
     _item_new_path = '/issues.json'
 
-    def __init__(self, redmine, *args, **kw_args):
-        # Override init to also set up sub-queries
-        # Call the base-class init
-        super(Issue, self).__init__(redmine, *args, **kw_args)
+    # Fields the server can filter issue queries by (see where)
+    _query_filters = {
+        'project': 'project_id',
+        'subproject': 'subproject_id',
+        'tracker': 'tracker_id',
+        'status': 'status_id',
+        'priority': 'priority_id',
+        'assigned_to': 'assigned_to_id',
+        'author': 'author_id',
+        'category': 'category_id',
+        'fixed_version': 'fixed_version_id',
+        'parent': 'parent_id',
+        'subject': 'subject',
+        'done_ratio': 'done_ratio',
+        'start_date': 'start_date',
+        'due_date': 'due_date',
+        'created_on': 'created_on',
+        'updated_on': 'updated_on',
+        'custom_fields': 'cf_%s',
+    }
+
+    # Many issues can be fetched at once by id, open or closed
+    _batch_filter = 'issue_id'
+    _batch_options = {'status_id': '*'}
+    # Redmine only lists open issues unless asked otherwise
+    _default_filters = {'status_id': 'open'}
 
-        # to manage time_entries for this issue
-        self._add_item_manager(
-            'time_entries', Time_Entry,
-            query_path='/issues/{id}/time_entries.json',
-            item_new_path='/issues/{id}/time_entries.json')
+    # to manage time_entries for this issue
+    time_entries = Sub_Manager(
+        'Time_Entry',
+        scope='issue_id',
+        query_path='/issues/{id}/time_entries.json',
+        item_new_path='/issues/{id}/time_entries.json')
 
     def __str__(self):
-        return '<Redmine issue #%s, "%s">' % (self.id, self.subject)
+        return '<Redmine issue #%s, "%s">' % (self.id, self._peek('subject'))
+
+    # Journals seen so far, and the updated_on of the issue at the time
+    _journals = None
+    _journals_updated_on = None
 
     @property
     def journals(self):
         """
-        Retrieve journals attribute for this very Issue
+        Retrieve journals attribute for this very Issue.
+
+        The journals are kept on the issue, and are only fetched again after
+        the issue's updated_on has changed.  Journals already seen are kept,
+        only the newer ones are added.
         """
-        try:
-            target = self._item_path
-            json_data = self._redmine.get(target % str(self.id),
+        if self._journals is None or \
+                self._journals_updated_on != self.updated_on:
+            json_data = self._redmine.get(self._item_path % self.id,
                                           parms={'include': 'journals'})
-            data = self._redmine.unwrap_json(None, json_data)
-            journals = [Journal(redmine=self._redmine,
+            data = self._redmine.unwrap_json(self._type, json_data)
+            data.setdefault('journals', [])
+            self._update_data(data=data)
+
+        return list(self._journals)
+
+    def _update_data(self, data={}):
+        '''Update the data in this issue, including any journals.'''
+        journal_data = data.pop('journals', None)
+        super(Issue, self)._update_data(data=data)
+        if journal_data is not None:
+            self._add_journals(journal_data)
+
+    def _add_journals(self, journal_data):
+        '''Add the journals that are newer than the ones already seen.'''
+        journals = self._journals or []
+        last_id = journals[-1].id if journals else 0
+        journals.extend(Journal(redmine=self._redmine,
                                 data=journal,
                                 type='issue_journal')
-                        for journal in data['issue']['journals']]
-
-            return journals
-
-        except Exception:
-            return []
+                        for journal in journal_data
+                        if journal['id'] > last_id)
+        object.__setattr__(self, '_journals', journals)
+        object.__setattr__(self, '_journals_updated_on', self.updated_on)
 
-    def save(self, notes=None):
+    def save(self, notes=None, check_conflicts=False):
         '''Save all changes back to Redmine with optional notes.'''
         # Capture the notes if given
         if notes:
-            self._changes['notes'] = notes
+            self._change_set()['notes'] = notes
 
         # Call the base-class save function
-        super(Issue, self).save()
+        super(Issue, self).save(check_conflicts=check_conflicts)
 
     def set_status(self, new_status, notes=None):
-        '''Save all changes and set to the given new_status'''
+        '''Save all changes and set to the given new_status.
+        The status can be given by either its ID or its name.'''
+        enumerations = self._redmine.enumerations
+        if isinstance(new_status, basestring):
+            new_status = enumerations.id('status', new_status)
         self.status_id = new_status
-        try:
-            self.status['id'] = self.status_id
-            # We don't have the id to name mapping, so blank the name
-            self.status['name'] = None
-        except:
-            pass
+
+        # Show the new status here too, without tracking it as a change.
+        # Its name is known once the statuses are loaded (as a name does),
+        # an id alone doesn't fetch them
+        status = {'id': new_status}
+        name = enumerations.name('status', new_status, fetch=False)
+        if name is not None:
+            status['name'] = name
+
+        object.__setattr__(self, 'status',
+                           self._redmine.check_cache('status', status))
         self.save(notes)
 
     def resolve(self, notes=None):
@@ -284,6 +382,120 @@ class Issue(Redmine_Item):
         self.set_status(self._redmine.ISSUE_STATUS_ID_CLOSED, notes=notes)
 
 
+class Issue_Relation(Redmine_Item):
+    '''Object representing a relation between two Redmine issues.'''
+    # data hints:
+    id = None
+    issue_id = None
+    issue_to_id = None
+    relation_type = None
+    delay = None
+
+    _protected_attr = ['id', 'issue_id', 'issue_to_id', 'relation_type']
+
+    # How to communicate this info to/from the server
+    _query_container = 'relations'
+    _item_path = '/relations/%s.json'
+
+    def __str__(self):
+        return '<Redmine issue relation #%s, %s %s %s>' % (
+            self.id, self._peek('issue_id'), self._peek('relation_type'),
+            self._peek('issue_to_id'))
+
+
+class Attachment(Redmine_Item):
+    '''Object representing a file attached to a Redmine item.'''
+    # data hints:
+    id = None
+    filename = None
+    filesize = None
+    content_type = None
+    description = None
+    content_url = None
+    author = None
+    created_on = None
+
+    _protected_attr = ['id',
+                       'filename',
+                       'filesize',
+                       'content_type',
+                       'content_url',
+                       'created_on',
+                       ]
+
+    _field_type = {
+        'author': 'user',
+        'created_on': 'datetime',
+    }
+
+    # How to communicate this info to/from the server
+    _item_path = '/attachments/%s.json'
+
+    def __str__(self):
+        return '<Redmine attachment #%s, "%s">' % (self.id,
+                                                   self._peek('filename'))
+
+
+class Issue_Status(Redmine_Item):
+    '''Object representing a Redmine issue status.'''
+    # data hints:
+    id = None
+    name = None
+    is_default = None
+    is_closed = None
+
+    _protected_attr = ['id', 'name', 'is_default', 'is_closed']
+
+    # How to communicate this info to/from the server
+    _query_container = 'issue_statuses'
+    _query_path = '/issue_statuses.json'
+
+    def __str__(self):
+        return '<Redmine issue status #%s, "%s">' % (self.id, self._peek('name'))
+
+
+class Issue_Priority(Redmine_Item):
+    '''Object representing a Redmine issue priority.'''
+    # data hints:
+    id = None
+    name = None
+    is_default = None
+
+    _protected_attr = ['id', 'name', 'is_default']
+
+    # How to communicate this info to/from the server
+    _query_container = 'issue_priorities'
+    _query_path = '/enumerations/issue_priorities.json'
+
+    def __str__(self):
+        return '<Redmine issue priority #%s, "%s">' % (self.id, self._peek('name'))
+
+
+class Issue_Category(Redmine_Item):
+    '''Object representing a Redmine issue category.
+    Categories belong to a project, see project.issue_categories'''
+    # data hints:
+    id = None
+    project = None
+    name = None
+    assigned_to = None
+
+    _field_type = {
+        'assigned_to': 'user',
+    }
+
+    _remap_to_id = [
+        'assigned_to',
+    ]
+
+    # How to communicate this info to/from the server
+    _query_container = 'issue_categories'
+    _item_path = '/issue_categories/%s.json'
+
+    def __str__(self):
+        return '<Redmine issue category #%s, "%s">' % (self.id, self._peek('name'))
+
+
 class Journal(Redmine_Item):
     """
     Object for representing a single Redmine issue journal entry.
@@ -313,12 +525,30 @@ class Journal(Redmine_Item):
 
 
 class Role(object):
-    '''Helper class to represent a project membership role'''
+    '''Helper class to represent a project membership role.
+    Roles can't be changed, so the same one is shared by every membership
+    (see Role.get).'''
+    __slots__ = ('id', 'name', 'inherited')
+
+    # (id, name, inherited) -> Role
+    _shared = {}
 
     def __init__(self, id, name, inherited=None):
-        self.id = id
-        self.name = name
-        self.inherited = inherited
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, 'inherited', inherited)
+
+    @classmethod
+    def get(cls, id, name, inherited=None):
+        '''Returns the shared role with the given values.'''
+        key = (id, name, inherited)
+        try:
+            return cls._shared[key]
+        except KeyError:
+            return cls._shared.setdefault(key, cls(id, name, inherited))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Can't set attribute %s, roles are shared." % name)
 
     def __str__(self):
         return '<Role #%s %s>' % (self.id, self.name)
@@ -356,7 +586,7 @@ class News(Redmine_Item):
     #_item_new_path = '/newss.json'
 
     def __str__(self):
-        return '<Redmine news #%s, %r>' % (self.id, self.title)
+        return '<Redmine news #%s, %r>' % (self.id, self._peek('title'))
 
 
 class Time_Entry(Redmine_Item):
@@ -384,6 +614,7 @@ class Time_Entry(Redmine_Item):
         'created_on': 'datetime',
         'updated_on': 'datetime',
         'spent_on': 'date',
+        'hours': 'float',
     }
 
     # these fields will map from tag to tag_id when saving the time entry.
@@ -396,6 +627,15 @@ class Time_Entry(Redmine_Item):
         'user',
     ]
 
+    # Fields the server can filter time entry queries by (see where)
+    _query_filters = {
+        'project': 'project_id',
+        'issue': 'issue_id',
+        'user': 'user_id',
+        'activity': 'activity_id',
+        'spent_on': 'spent_on',
+    }
+
     # How to communicate this info to/from the server
     _query_container = 'time_entries'
     _query_path = '/time_entries.json'
@@ -405,14 +645,15 @@ class Time_Entry(Redmine_Item):
     def __str__(self):
         try:
             try:
-                issue = ' issue #%s' % self.issue['id']
+                issue = ' issue #%s' % self._peek('issue')['id']
             except KeyError:
                 issue = ''
             try:
-                project = ' "%s"' % self.project['name']
+                project = ' "%s"' % self._peek('project')['name']
             except KeyError:
                 project = ''
-            map = (self.id, self.user['name'], project, issue, self.hours)
+            map = (self.id, self._peek('user')['name'], project, issue,
+                   self._peek('hours'))
             return '<Redmine Time Entry #%s: "%s"'\
                    ' worked on%s%s for %s hours>' % map
 
@@ -462,11 +703,13 @@ class Membership(Redmine_Item):
 
     _query_container = 'memberships'
 
-    def __init__(self, redmine, *args, **kw_args):
-        # Call the base-class init
-        super(Membership, self).__init__(redmine, *args, **kw_args)
-
-        self.roles = [Role(**role) for role in self.roles]
+    def _update_data(self, data={}):
+        '''Update the data in this membership, with shared roles.'''
+        roles = data.pop('roles', None)
+        super(Membership, self)._update_data(data=data)
+        if roles is not None:
+            object.__setattr__(self, 'roles',
+                               [Role.get(**role) for role in roles])
 
     def __str__(self):
         return '<Redmine project membership #%s>' % (self.id,)
@@ -536,7 +779,8 @@ class User(Redmine_Item):
     _item_new_path = '/users.json'
 
     def __str__(self):
-        return '<Redmine user #%s, "%s %s">' % (self.id, self.firstname, self.lastname)
+        return '<Redmine user #%s, "%s %s">' % (
+            self.id, self._peek('firstname'), self._peek('lastname'))
 
 
 class Wiki_Page(Redmine_Item):
@@ -586,7 +830,8 @@ class Wiki_Page(Redmine_Item):
     _update_path = '/projects/%s.json'
 
     def __str__(self):
-        return '<Redmine wiki page %s:%s>' % (self.title, self.version)
+        return '<Redmine wiki page %s:%s>' % (self._peek('title'),
+                                              self._peek('version'))
 
     # No numeric ID, don't return an int representation
     def __int__(self):
@@ -607,8 +852,9 @@ class Redmine_Wiki_Pages_Manager(Redmine_Items_Manager):
                                        item_new_path=path)
         self._project = project
 
-    def _objectify(self, json_data=None, data={}):
-        '''Return an object derived from the given json data.'''
+    def _objectify(self, json_data=None, data={}, partial=False):
+        '''Return an object derived from the given json data.
+        Pages are never partial, as they can't be fetched by id alone.'''
         if json_data:
             # Parse the data
             try:
@@ -658,7 +904,9 @@ class Redmine(Redmine_WS):
                        [username=<string>,
                        password=<string>],
                        [version=<#.#>],
-                       [impersonate=<string>])
+                       [impersonate=<string>],
+                       [compact=<bool>],
+                       [workers=<int>])
 
     url is the base url of the Redmine install ('http://my.server/redmine')
 
@@ -672,6 +920,14 @@ class Redmine(Redmine_WS):
     If impersonate is set and the logged in user has administrator privileges,
     the user will be switched.
 
+    workers is how many requests may be sent at once when that helps,
+    such as when saving many items together.  It defaults to 4.
+
+    If compact is set, items are stored using __slots__ instead of a
+    per-item dictionary, which uses much less memory when many thousands of
+    items are held at once.  See benchmark/item_memory.py for the savings
+    of each item type.
+
     When the version parameter is set, only items available in that version of
     Redmine are enabled.  For instance, version 1.0 only supports issue and
     project management, but issue 1.1 adds users, news and time entries and
@@ -689,8 +945,56 @@ class Redmine(Redmine_WS):
     news
     time_entries
 
+    Redmine version 1.3 adds:
+    issue_statuses
+
     Redmine version 2.2 adds:
     time_entry_activities
+    issue_priorities
+
+    The enumerations attribute resolves the names and ids of issue statuses,
+    priorities, trackers, categories and time entry activities, which are
+    loaded from the server once when first needed:
+
+    >>> instance.enumerations.id('status', 'Resolved')
+    3
+
+    Names can be given for those fields on an item too, they are sent as
+    ids (category names are looked up in the item's project).
+
+    Saving an item only sends the fields whose value differs from what the
+    server last sent.  When nothing differs, no request is made at all, and
+    the requests_avoided counter goes up instead.
+
+    To save many changed items at once, several at a time (see workers),
+    use a unit of work:
+
+    >>> with instance.unit_of_work() as work:
+    ...     for issue in issues:
+    ...         issue.done_ratio = 100
+    >>> work.failed
+    []
+
+    To bring cached items up to date, such as in a long running service,
+    revalidate fetches again those read more than max_age seconds ago.
+    Issues are fetched 100 per request:
+
+    >>> instance.revalidate('issue', max_age=300)
+    {}
+
+    Cached items can be found by field without asking the server, and
+    indexing a field makes that quick even with many items cached:
+
+    >>> instance.issues.add_index('assigned_to')
+    >>> instance.issues.cached(assigned_to=7, status=1)
+
+    Once every issue is cached (such as by a sync), mark the cache as a
+    current replica, and issue queries are answered from it whenever their
+    filters allow.  Including subprojects also needs every project cached:
+
+    >>> instance.mark_replica_current('issue')
+    >>> instance.mark_replica_current('project')
+    >>> instance.issues(status_id='closed', assigned_to_id=7)
     '''
     # Status ID from a default install
     ISSUE_STATUS_ID_NEW = 1
@@ -723,7 +1027,7 @@ class Redmine(Redmine_WS):
             #versions
             #queries
             #attachments
-            #issue statuses
+            'issue_statuses': Issue_Status,
             #trackers
             #issue categories
         },
@@ -738,6 +1042,7 @@ class Redmine(Redmine_WS):
 
         2.2: {
             'time_entry_activities': Time_Entry_Activity,
+            'issue_priorities': Issue_Priority,
         },
     }
 
@@ -771,6 +1076,7 @@ class Redmine(Redmine_WS):
         self.has_project_memberships = version_check >= 1.4
         self.has_project_versions = version_check >= 1.3
         self.has_wiki_pages = version_check >= 2.2
+        self.has_issue_categories = version_check >= 1.3
 
         ## ITEM MANAGERS
         # Step through all the item managers by version
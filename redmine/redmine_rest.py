@@ -19,17 +19,456 @@
 import urllib
 import urllib2
 import json
+import re
+import threading
+import Queue
+import time
+import atexit
+import weakref
+import calendar
+import mmap
+import tempfile
+from array import array
+from itertools import islice
+from datetime import datetime, date
 from dateutil.parser import parse as datetime_parse
+from dateutil.tz import tzutc, tzoffset
+
+try:
+    import numpy
+except ImportError:
+    # Only needed for query_columns(as_numpy=True)
+    numpy = None
 
 class RedmineError(StandardError):
     pass
 
 
+class RedmineConflictError(RedmineError):
+    '''Raised by save(check_conflicts=True) when the item was changed on the
+    server since it was last read.
+
+    item is the item that wasn't saved, still holding its changes.
+    server_data is what the server has now.'''
+
+    def __init__(self, item, server_data):
+        RedmineError.__init__(self, '%s #%s was changed on the server.'
+                              % (item._type, item.id))
+        self.item = item
+        self.server_data = server_data
+
+
+class Bulk_Create_Error(RedmineError):
+    '''Raised when some of the items given to new_many couldn't be created.
+
+    created is the list of items that were created, in input order.
+    errors maps the position of each failed record to its exception.
+    checkpoint can be passed back to new_many, with the same records,
+    to carry on where it stopped.'''
+
+    def __init__(self, created, errors, checkpoint):
+        RedmineError.__init__(self, '%d of the items could not be created.'
+                              % len(errors))
+        self.created = created
+        self.errors = errors
+        self.checkpoint = checkpoint
+
+
+def run_concurrently(function, args_list, workers=1):
+    '''Call function once for each entry in args_list using up to
+    workers threads.  Returns a list of (result, error) pairs in the same
+    order as args_list.  An exception raised by one call is stored as its
+    error and does not stop the others.'''
+    args_list = list(args_list)
+    results = [None] * len(args_list)
+
+    def call(index):
+        try:
+            results[index] = (function(args_list[index]), None)
+        except Exception, e:
+            results[index] = (None, e)
+
+    # Not worth starting any threads
+    if workers <= 1 or len(args_list) <= 1:
+        for index in range(len(args_list)):
+            call(index)
+        return results
+
+    pending = Queue.Queue()
+    for index in range(len(args_list)):
+        pending.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except Queue.Empty:
+                return
+            call(index)
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(workers, len(args_list)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# Redmine sends dates as 2013-02-07 and times as 2013-02-07T01:00:28Z
+# (or with a +01:00 style offset).  Anything else goes to dateutil.
+_iso_datetime = re.compile(r'(\d{4})-(\d\d)-(\d\d)'
+                           r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6})\d*)?)?'
+                           r' ?(Z|[+-]\d\d:?\d\d)?)?$')
+_utc = tzutc()
+_tz_offsets = {}
+
+
+def parse_datetime(value):
+    '''Turn a date or date/time string from Redmine into a datetime object.'''
+    match = _iso_datetime.match(value)
+    if not match:
+        return datetime_parse(value)
+
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    tzinfo = None
+    if zone == 'Z':
+        tzinfo = _utc
+    elif zone:
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        if zone[0] == '-':
+            offset = -offset
+        try:
+            tzinfo = _tz_offsets[offset]
+        except KeyError:
+            tzinfo = _tz_offsets[offset] = offset and tzoffset(None, offset) or _utc
+
+    try:
+        return datetime(int(year), int(month), int(day),
+                        int(hour or 0), int(minute or 0), int(second or 0),
+                        int(fraction.ljust(6, '0')) if fraction else 0,
+                        tzinfo)
+    except ValueError:
+        # Out of range values, let dateutil decide what to do
+        return datetime_parse(value)
+
+
+class _Date_Field(object):
+    '''Holds a date or datetime field of a Redmine_Item.
+    The string from the server is stored as is, and is only parsed into a
+    datetime the first time the field is read.
+    Items keep the value in their __dict__, or in a slot if given.'''
+
+    def __init__(self, name, slot=None):
+        self.name = name
+        self.slot = slot
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            # Still serves as the data hint on the class
+            return None
+        if self.slot:
+            value = getattr(obj, self.slot)
+        else:
+            value = obj.__dict__.get(self.name)
+        if value is None and obj._fault_in_field(self.name):
+            return self.__get__(obj, cls)
+        if isinstance(value, basestring):
+            value = parse_datetime(value)
+            self.__set__(obj, value)
+        return value
+
+    def __set__(self, obj, value):
+        if self.slot:
+            object.__setattr__(obj, self.slot, value)
+        else:
+            obj.__dict__[self.name] = value
+
+
+class _Field_Hint(object):
+    '''Stands in for a data hint (a field set to None on the class).
+    Reads as None, except on a partial item, where the first read of a field
+    its data didn't have fetches its full details.'''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls):
+        if obj is not None and obj._fault_in_field(self.name):
+            return getattr(obj, self.name)
+        return None
+
+
+class Sub_Manager(object):
+    '''An item manager belonging to each item of a class, such as project.issues.
+
+    Declare it on the class with either the name of the item class and the
+    paths to use, where {id} is replaced by the owning item's id:
+
+        issues = Sub_Manager('Issue', query_path='/projects/{id}/issues.json')
+
+    or with a factory that is given the owning item and returns the manager.
+    If available names a flag on the Redmine object (ie: 'has_wiki_pages'),
+    the manager only exists when that flag is set.  If scope names the query
+    filter the paths stand for (ie: 'project_id'), queries answered from the
+    cache are limited to the owning item too.
+
+    The manager is only created the first time it is used, and then kept
+    in the item's __dict__.'''
+    # Set by Redmine_Item_Type to the attribute name
+    name = None
+
+    def __init__(self, item_class=None, factory=None, available=None,
+                 scope=None, **paths):
+        self.item_class = item_class
+        self.factory = factory
+        self.available = available
+        self.scope = scope
+        self.paths = paths
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        redmine = obj._redmine
+        if self.available and not getattr(redmine, self.available, False):
+            raise AttributeError('%s is not available for %s'
+                                 % (self.name, obj._type))
+
+        if self.factory:
+            manager = self.factory(obj)
+        else:
+            paths = dict((path_type, path.format(id=obj.id))
+                         for path_type, path in self.paths.iteritems())
+            item_class = redmine.item_class[self.item_class.lower()]
+            scope = {self.scope: obj.id} if self.scope else None
+            manager = Redmine_Items_Manager(redmine, item_class,
+                                            scope=scope, **paths)
+
+        obj.__dict__[self.name] = manager
+        return manager
+
+
+def _keep(redmine, value):
+    '''Decoder for fields stored just as the server sent them.'''
+    return value
+
+
+def _number_decoder(number_type):
+    '''Returns a decoder for numbers, which leaves anything else as is.'''
+    def decode(redmine, value):
+        try:
+            return number_type(value)
+        except (TypeError, ValueError):
+            return value
+    return decode
+
+
+def _reference_decoder(item_type):
+    '''Returns a decoder turning data for the given type into a cached item,
+    or a list of them.'''
+    def decode(redmine, value):
+        if isinstance(value, list):
+            return [redmine.check_cache(item_type, entry) for entry in value]
+        return redmine.check_cache(item_type, value)
+    return decode
+
+
+def _include_parameter(include):
+    '''Returns the include= parameter for a list of included data.'''
+    if isinstance(include, basestring):
+        return include
+    return ','.join(include)
+
+
+def _strftime_encoder(format):
+    '''Returns an encoder turning a date or datetime into the string Redmine expects.'''
+    def encode(value):
+        try:
+            return value.strftime(format)
+        except AttributeError:
+            # Not a date, send as is
+            return value
+    return encode
+
+
+# The keys of data that only refers to an item
+_reference_keys = frozenset(['id', 'name'])
+
+
+class Redmine_Reference(object):
+    '''A reference from one item to another, such as the status of an issue,
+    when that other item has no class of its own.
+
+    The same reference is shared by every item that refers to that id
+    (see Redmine_WS.check_cache), so it can't be changed.  It reads like
+    both a Redmine_Item and the dict Redmine sent:
+
+    >>> issue.status.name
+    u'New'
+    >>> issue.status['id']
+    1'''
+    __slots__ = ('_type', 'id', 'name')
+
+    def __init__(self, type, id, name=None):
+        object.__setattr__(self, '_type', type)
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'name', name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Can't set attribute %s, %s references are shared."
+                             % (name, self._type))
+
+    def __getitem__(self, key):
+        if key not in _reference_keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if isinstance(other, Redmine_Reference):
+            return (self._type, self.id) == (other._type, other.id)
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, Redmine_Reference):
+            return not self == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self._type, self.id))
+
+    def __repr__(self):
+        if self.name is None:
+            return '<Redmine %s #%s>' % (self._type, self.id)
+        return '<Redmine %s #%s - %s>' % (self._type, self.id, self.name)
+
+    def __int__(self):
+        return self.id
+
+    def __str__(self):
+        if self.name is None:
+            return self.__repr__()
+        return self.name
+
+
+class Item_Schema(object):
+    '''How to read and write the fields of one Redmine_Item class.
+    Worked out once from the class settings (_protected_attr, _remap_to_id,
+    _field_type and _include_only) when the class is defined.'''
+
+    _decoders_by_type = {
+        'date': _keep,
+        'datetime': _keep,
+        'float': _number_decoder(float),
+        'int': _number_decoder(int),
+    }
+
+    _encoders_by_type = {
+        'date': _strftime_encoder('%Y-%m-%d'),
+        'datetime': _strftime_encoder('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+    def __init__(self, item_class):
+        self.item_class = item_class
+        self.protected = frozenset(item_class._protected_attr)
+        self.remap = frozenset(item_class._remap_to_id)
+        # Every field the server may send
+        fields = set(item_class._field_type)
+        for klass in item_class.__mro__:
+            for name, value in vars(klass).iteritems():
+                if not name.startswith('_') and \
+                        (value is None or isinstance(value, _Field_Hint)):
+                    fields.add(name)
+        self.fields = frozenset(fields)
+        # The ones in the item's own details, which partial items fetch
+        # when read (included data is only sent when asked for)
+        self.detail_fields = self.fields.difference(item_class._include_only)
+        # The distinct sets of field names partial items were sent, shared
+        # between the items (most of a query's items have the same ones)
+        self._field_sets = {}
+
+        # field -> function(redmine, value) giving the value to store
+        # Fields that aren't listed are decoded as a cached item of their own name.
+        self.decoders = {}
+        # field -> function(value) giving the value to send to the server
+        self.encoders = {}
+        for field, field_type in item_class._field_type.iteritems():
+            try:
+                self.decoders[field] = self._decoders_by_type[field_type]
+            except KeyError:
+                self.decoders[field] = _reference_decoder(field_type)
+            try:
+                self.encoders[field] = self._encoders_by_type[field_type]
+            except KeyError:
+                pass
+
+    # Past this many distinct sets, new ones aren't shared any more
+    _max_field_sets = 64
+
+    def field_set(self, names, more=None):
+        '''Returns a frozenset of the given field names, and those of more
+        if given, shared with the items that have the same ones.'''
+        names = frozenset(names)
+        if more:
+            names = names.union(more)
+        field_sets = self._field_sets
+        if len(field_sets) >= self._max_field_sets:
+            return field_sets.get(names, names)
+        return field_sets.setdefault(names, names)
+
+    def encode(self, changes, redmine=None, project=None):
+        '''Convert the given changes in place to what the server expects.
+        project is the one the item is in, if known.'''
+        for tag in changes.keys():
+            if tag in self.remap:
+                self.item_class._remap_tag_to_tag_id(tag, changes, redmine,
+                                                     project)
+                continue
+            try:
+                encode = self.encoders[tag]
+            except KeyError:
+                continue
+            changes[tag] = encode(changes[tag])
+
+
+class Redmine_Item_Type(type):
+    '''Prepares each Redmine_Item class as it is defined.'''
+
+    def __init__(cls, name, bases, attributes):
+        super(Redmine_Item_Type, cls).__init__(name, bases, attributes)
+
+        cls._schema = Item_Schema(cls)
+
+        for key, value in attributes.iteritems():
+            if isinstance(value, Sub_Manager):
+                value.name = key
+            elif value is None and not key.startswith('_'):
+                setattr(cls, key, _Field_Hint(key))
+
+        # Date fields are parsed when they are first read
+        for field, field_type in cls._field_type.iteritems():
+            if field_type in ('date', 'datetime') and \
+                    not isinstance(attributes.get(field), _Date_Field):
+                setattr(cls, field, _Date_Field(field))
+
+
+# Stands in for a field that an item doesn't have
+_missing = object()
+
+
 # Base class used for all items returned from Redmine.
 # If an field in an item has an ID but there's no derived class
 # to describe that item, the field will be cast into this class.
 class Redmine_Item(object):
     '''A generic representation of an item in Redmine.'''
+    __metaclass__ = Redmine_Item_Type
+
     # Data hints
     id = None
 
@@ -41,8 +480,15 @@ class Redmine_Item(object):
 
     _type = None
 
-    # Tracks changed attributes on this object.  __init__ sets it to {} to kick off tracking.
+    # Tracks changed attributes on this object.  Changes are only tracked once
+    # _update_data has loaded the server data, and the dict is only created
+    # when the first change is made.
     _changes = None
+    _tracking = False
+
+    # The server's value of each changed field, recorded on its first change.
+    # Changes that set a field back to that value aren't sent.
+    _originals = None
 
     # These tags are remapped from tag to tag_id when creating or saving
     _remap_to_id = []
@@ -58,6 +504,41 @@ class Redmine_Item(object):
     # Will be filled by the get method
     _source_path = ''
 
+    # True when only some of this item's data is known,
+    # such as when another item refers to it by id and name,
+    # or it came from a query.  Reading a field that wasn't in its
+    # data (_known_fields) fetches the full details, along with the
+    # rest of _fault_group.  That is only tried once.
+    _partial = False
+    _known_fields = None
+    _fault_group = None
+
+    # Fields only sent when asked for with include=, which reading
+    # doesn't fetch (ie: issue.children)
+    _include_only = []
+
+    # True for items made without being put in the cache (such as spilled
+    # query results), which the cache indexes leave out
+    _uncached = False
+
+    # When the item's full details were last read from the server
+    # (as from time.time()) and the ETag the server sent with them
+    _fetched_at = None
+    _etag = None
+
+    # Filters the server applies to queries that don't say otherwise,
+    # which are applied to queries answered from the cache too
+    _default_filters = {}
+
+    # The query filters the server has for fields of these items,
+    # as {field: filter}, and 'custom_fields': 'cf_%s' if it filters those
+    _query_filters = {}
+
+    # A filter that gets many of these items by id at once in a query
+    # (ie: issue_id=1,2,3), and any other options that query needs
+    _batch_filter = None
+    _batch_options = {}
+
     @classmethod
     def _get_type(cls):
         '''Returns the object type string.
@@ -77,64 +558,227 @@ class Redmine_Item(object):
     def _update_data(self, data={}):
         '''Update the data in this object.'''
 
-        # Store the changes to prevent this update from affecting it
-        pending_changes = self._changes or {}
+        # Stop tracking changes to prevent this update from affecting them
+        object.__setattr__(self, '_tracking', False)
         try:
-            del self._changes
-        except:
-            pass
-
-        # Map custom fields into our custom fields object
-        try:
-            custom_field_data = data.pop('custom_fields')
-        except KeyError:
-            pass
-        else:
-            self.custom_fields = Custom_Fields(custom_field_data)
-
-        # Map all other dictionary data to object attributes
-        for key, value in data.iteritems():
-            lookup_key = self._field_type.get(key, key)
-
-            # if it's a datetime object, turn into proper DT object
-            if lookup_key == 'datetime' or lookup_key == 'date':
-                self.__dict__[key] = datetime_parse(value)
+            # Map custom fields into our custom fields object
+            try:
+                custom_field_data = data.pop('custom_fields')
+            except KeyError:
+                pass
             else:
-                # Check to see if there's cache data for this item.
-                # Will return an object if it's recognized as one.
-                self.__dict__[key] = self._redmine.check_cache(lookup_key, value)
-
-
-        # Set the changes dict to track all changes from here on out
-        self._changes = pending_changes
+                self.custom_fields = Custom_Fields(
+                    custom_field_data,
+                    getattr(self._redmine, 'custom_field_definitions', None))
+
+            # Map all other dictionary data to object attributes
+            redmine = self._redmine
+            decoders = self._schema.decoders
+            for key, value in data.iteritems():
+                try:
+                    decode = decoders[key]
+                except KeyError:
+                    # Check to see if there's cache data for this item.
+                    # Will return an object if it's recognized as one.
+                    value = redmine.check_cache(key, value)
+                else:
+                    # Typed field, dates are kept as strings until they are read
+                    value = decode(redmine, value)
+                object.__setattr__(self, key, value)
+
+            # Keep any indexes on this type's fields up to date
+            indexes = getattr(redmine, '_indexes', None)
+            if indexes and self._type in indexes:
+                self._reindex(data)
+
+            # Changes are now compared against the fresh server data
+            originals = self._originals
+            if originals:
+                for key in data:
+                    if key in originals:
+                        originals[key] = getattr(self, key)
+        finally:
+            # Track all changes from here on out
+            object.__setattr__(self, '_tracking', True)
+
+    def __getattr__(self, name):
+        # Only called for fields without a data hint, such as issue.author
+        if not name.startswith('_') and self._fault_in_field(name):
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def _fault_in_field(self, name):
+        '''Fetch the full details of this partial item if the given field
+        wasn't in its data and would be in the details.
+        Returns True if they were fetched.'''
+        if not self._partial or name not in self._schema.detail_fields:
+            return False
+        known = self._known_fields
+        if known is not None and name in known:
+            # Sent, as None
+            return False
+        return self._fault_in()
+
+    def _fault_in(self):
+        '''Fetch the full details of this partial item, along with the other
+        items still partial from the same query page.
+        Returns False if items of this type can't be fetched by id, or if
+        the fetch failed: the fields it would have given then read as
+        missing, as on any other item, and it isn't tried again.'''
+        object.__setattr__(self, '_partial', False)
+        redmine = self._redmine
+        item_class = getattr(redmine, 'item_class', {}).get(self._type)
+        if item_class is None or self.id is None or \
+                not (item_class._item_path or item_class._batch_filter):
+            return False
+        ids = set([self.id])
+        if self._fault_group:
+            cached = redmine.item_cache.get(self._type, {})
+            for id in self._fault_group:
+                item = cached.get(id)
+                if item is not None and item._partial:
+                    ids.add(id)
+        try:
+            errors = redmine.fetch_items(self._type, ids)
+        except Exception, e:
+            # ie: the query of a _batch_filter failed
+            errors = dict((id, e) for id in ids)
+        # Whatever they didn't get, fetching them again wouldn't either
+        cached = redmine.item_cache.get(self._type, {})
+        for id in ids:
+            item = cached.get(id)
+            if item is not None:
+                object.__setattr__(item, '_partial', False)
+        if self.id in errors:
+            if redmine.debug:
+                print 'Could not fetch %s %s: %s' % (self._type, self.id,
+                                                     errors[self.id])
+            return False
+        return True
+
+    def _peek(self, name, default=None):
+        '''Read a field without fetching the details of a partial item.'''
+        partial = self._partial
+        if partial:
+            object.__setattr__(self, '_partial', False)
+        try:
+            return getattr(self, name, default)
+        finally:
+            if partial:
+                object.__setattr__(self, '_partial', True)
+
+    def _reindex(self, values):
+        '''Update the cache indexes for the given fields, from their values here.
+        Fields set through their id (status_id) are indexed as the field
+        (status) with the given value.'''
+        redmine = self._redmine
+        indexes = redmine._indexes.get(self._type)
+        if not indexes or self._uncached:
+            return
+        with redmine._cache_lock:
+            for name in values:
+                if name in indexes:
+                    indexes[name].update(self.id, self._peek(name))
+                elif name.endswith('_id') and name[:-3] in indexes:
+                    indexes[name[:-3]].update(self.id, values[name])
+
+    def _record_original(self, name):
+        '''Remember the server value of a field before it is first changed.'''
+        if self._originals is None:
+            object.__setattr__(self, '_originals', {})
+        # status_id = 5 changes the status field
+        source = name
+        if name.endswith('_id') and name[:-3] in self._schema.remap:
+            source = name[:-3]
+        self._originals[name] = self._peek(source, _missing)
+
+    def _reference_id(self, tag, value):
+        '''Return the id that a value given for a remapped field stands for.'''
+        if isinstance(value, dict):
+            return value.get('id')
+        if isinstance(value, basestring):
+            if value.isdigit():
+                return int(value)
+            try:
+                return self._redmine.enumerations.id(
+                    tag, value, project=self._peek('project'))
+            except (KeyError, AttributeError):
+                return value
+        return getattr(value, 'id', value)
+
+    def _is_unchanged(self, name, value):
+        '''Returns True if the value is what the server already has for the field.'''
+        try:
+            original = self._originals[name]
+        except (KeyError, TypeError):
+            return False
+        if original is _missing:
+            return False
+        try:
+            if original == value:
+                return True
+        except TypeError:
+            # ie: comparing a naive datetime with one that has a time zone
+            return False
+
+        # For remapped fields, the same id means the same value
+        tag = name[:-3] if name.endswith('_id') else name
+        if tag not in self._schema.remap or original is None:
+            return False
+        return self._reference_id(tag, original) == \
+            self._reference_id(tag, value)
+
+    def _drop_unchanged(self):
+        '''Forget any changes that leave a field as the server has it.'''
+        changes = self._changes
+        if changes and self._originals:
+            for name in changes.keys():
+                if self._is_unchanged(name, changes[name]):
+                    del changes[name]
+
+    def _is_dirty(self):
+        '''Returns True if this item has changes that haven't been saved.'''
+        if self._changes:
+            return True
+        return getattr(getattr(self, 'custom_fields', None), 'changed', False)
+
+    def _change_set(self):
+        '''Returns the dict of tracked changes, creating it if needed.'''
+        if self._changes is None:
+            object.__setattr__(self, '_changes', {})
+        return self._changes
+
+    # Printing an item only shows what it has, without fetching anything
 
     def __repr__(self):
-        try:
-            return '<Redmine %s #%s - %s>' % (self._type, self.id, self.name)
-        except:
+        name = self._peek('name', _missing)
+        if name is _missing:
             return '<Redmine %s #%s>' % (self._type, self.id)
+        return '<Redmine %s #%s - %s>' % (self._type, self.id, name)
 
     def __int__(self):
         return self.id
 
     def __str__(self):
-        try:
-            return self.name
-        except:
+        name = self._peek('name', _missing)
+        if name is _missing:
             return self.__repr__()
+        return name
 
     def __setattr__(self, name, value):
         '''Set the attribute for any non-protected attribute.'''
-        if name in self._protected_attr:
+        if name in self._schema.protected:
             raise AttributeError("Can't set attribute %s." % name)
-        # Track any new changes for later saving
-        try:
-            self._changes[name] = value
-        except TypeError:
-            pass
+        # Track any new changes for later saving, internal attributes
+        # (ie: _fetched_at) aren't fields of the item
+        if self._tracking and not name.startswith('_'):
+            changes = self._change_set()
+            if name not in changes:
+                self._record_original(name)
+            changes[name] = value
 
         # Set the instance value
-        self.__dict__[name] = value
+        object.__setattr__(self, name, value)
 
     def __getitem__(self, key):
         # Returned when self[key] is called
@@ -163,7 +807,7 @@ class Redmine_Item(object):
     def _check_custom_fields(self):
         # Check for any changes in the custom fields, if mapped
         # Custom fields need to be sent as "custom_field_values" as a dict referenced by the custom field ID.
-        if self._changes.has_key('custom_fields'):
+        if self._changes and self._changes.has_key('custom_fields'):
             # it's a new field - copied outside our scope
             try:
                 # Try to grab changes from the object
@@ -192,11 +836,17 @@ class Redmine_Item(object):
             return
 
         # We've got changes, map them to the required field
-        self._changes['custom_field_values'] = custom_changed._get_changes()
+        custom_changes = custom_changed._get_changes()
+        if custom_changes:
+            self._change_set()['custom_field_values'] = custom_changes
 
     @classmethod
-    def _remap_tag_to_tag_id(cls, tag, new_data):
-        '''Remaps a given changed field from tag to tag_id.'''
+    def _remap_tag_to_tag_id(cls, tag, new_data, redmine=None, project=None):
+        '''Remaps a given changed field from tag to tag_id.
+        If the Redmine instance is given, names of enumerated values
+        (such as a status name) are looked up and replaced by their id.
+        Category names are looked up in the project being set in new_data,
+        or else in the given project.'''
         try:
             value = new_data[tag]
         except:
@@ -214,61 +864,88 @@ class Redmine_Item(object):
             except AttributeError:
                 # If the changes field is not a dict or object, just use whatever value was given
                 new_data[tag_id] = value
+                # Swap a known name (ie: 'Closed') for its id
+                if redmine and isinstance(value, basestring):
+                    project = new_data.get('project_id',
+                                           new_data.get('project', project))
+                    try:
+                        new_data[tag_id] = redmine.enumerations.id(
+                            tag, value, project=project)
+                    except KeyError:
+                        pass
 
         # Remove the tag from the changed data
         del new_data[tag]
 
-    def _add_item_manager(self, key, item_class, **paths):
-        '''
-        Add an item manager to this object.
-        '''
-        updated_paths = {}
-        for path_type, path_value in paths.iteritems():
-            updated_paths[path_type] = path_value.format(**self.__dict__)
-
-        manager = Redmine_Items_Manager(self._redmine, item_class,
-                                        **updated_paths)
-        self.__dict__[key] = manager
+    def save(self, check_conflicts=False):
+        '''Save all changes on this item (if any) back to Redmine.
 
-    def save(self):
-        '''Save all changes on this item (if any) back to Redmine.'''
+        With check_conflicts, the item is first revalidated with the server,
+        and RedmineConflictError is raised instead of saving if someone else
+        changed it (its updated_on moved on) since it was read.  A save
+        leaves updated_on unknown (None) until the item is read again, and
+        there is nothing to check until then.'''
         self._check_custom_fields()
 
         if not self._changes:
             return None
 
-        for tag in self._remap_to_id:
-            self._remap_tag_to_tag_id(tag, self._changes)
-
-        # Check for custom handlers for tags
-        for tag, type in self._field_type.items():
-            try:
-                raw_data = self._changes[tag]
-            except:
-                continue
-
-            # Convert datetime type to a datetime string that Redmine expects
-            if type == 'datetime':
-                try:
-                    self._changes[tag] = raw_data.strftime('%Y-%m-%dT%H:%M:%S%z')
-                except AttributeError:
-                    continue
+        # Don't bother the server with values it already has
+        self._drop_unchanged()
+        if not self._changes:
+            self._clear_changes()
+            self._redmine.count_avoided_request()
+            return None
 
-            # Convert date type to a date string that Redmine expects
-            if type == 'date':
-                try:
-                    self._changes[tag] = raw_data.strftime('%Y-%m-%d')
-                except AttributeError:
-                    continue
+        if check_conflicts:
+            self._check_conflicts()
 
+        # Remap tags to tag_id and convert dates to the strings Redmine expects
+        self._schema.encode(self._changes, self._redmine,
+                            self._peek('project'))
 
         try:
             self._update(self._changes)
         except:
             raise
         else:
+            # The server now has these values
+            self._refer_to_ids(self._changes)
+            if self._redmine._indexes:
+                self._reindex(self._changes)
             # Successful save, woot! Now clear the changes dict
+            self._clear_changes()
+            # The server has a newer version than the one read
+            object.__setattr__(self, '_etag', None)
+            object.__setattr__(self, '_fetched_at', None)
+            # whose updated_on isn't known until the item is read again,
+            # so a conflict check doesn't mistake this save for someone else's
+            if self._peek('updated_on') is not None:
+                object.__setattr__(self, 'updated_on', None)
+
+    def _refer_to_ids(self, changes):
+        '''Point each remapped field sent as its id (status_id) at the item
+        with that id, so the field reads as the server now has it.'''
+        redmine = self._redmine
+        for name, value in changes.iteritems():
+            tag = name[:-3]
+            if not name.endswith('_id') or tag not in self._schema.remap:
+                continue
+            key = _index_key(value)
+            if key is None:
+                object.__setattr__(self, tag, None)
+            elif isinstance(key, (int, long)):
+                object.__setattr__(self, tag, redmine.check_cache(
+                    self._field_type.get(tag, tag), {'id': key}))
+
+    def _clear_changes(self):
+        '''Forget all tracked changes.'''
+        if self._changes:
             self._changes.clear()
+        object.__setattr__(self, '_originals', None)
+        custom_fields = getattr(self, 'custom_fields', None)
+        if custom_fields is not None:
+            custom_fields._clear_changes()
 
     def _update(self, dict):
         if not self._item_path:
@@ -281,80 +958,708 @@ class Redmine_Item(object):
         self._redmine.put(target, payload)
 
 
-    def refresh(self):
+    def refresh(self, max_age=None):
         '''Refresh this item from data on the server.
-        Will save any unsaved data first.'''
+
+        If the item was read less than max_age seconds ago, nothing is done.
+        Otherwise the server is asked for the item only if it changed
+        since it was read, so an unchanged item is a cheap request.
+
+        Unsaved changes aren't saved, they are kept on top of the new data.'''
 
         if not self._item_path:
             raise AttributeError('refresh is not available for %s' % self._type)
         if not self.id:
             raise RedmineError('%s did not come from the Redmine server - no link.' % self._type)
 
-        try:
-            self.save()
-        except:
-            pass
+        if max_age is not None and self._fetched_at is not None and \
+                time.time() - self._fetched_at < max_age:
+            self._redmine.count_avoided_request()
+            return
 
-        # Mimic the Redmine_Item_Manager.get command
-        target = self._item_path % self.id
-        json_data = self._redmine.get(target)
-        data = self._redmine.unwrap_json(self._type, json_data)
+        data = self._fetch_if_modified()
+        if data is None:
+            return
+        changes = self._changes
+        custom_fields = getattr(self, 'custom_fields', None)
         self._update_data(data=data)
+        object.__setattr__(self, '_partial', False)
+        if changes:
+            for name, value in changes.iteritems():
+                object.__setattr__(self, name, value)
+        # The custom fields are made anew from the data
+        if custom_fields is not None and custom_fields.changed and \
+                self.custom_fields is not custom_fields:
+            self.custom_fields._keep_changes(custom_fields)
+
+    def _fetch_if_modified(self):
+        '''Returns the item's data from the server, or None if it hasn't
+        changed since it was last read.'''
+        target = self._item_path % self.id
+        json_data, etag = self._redmine.get_if_modified(target, self._etag)
+        object.__setattr__(self, '_fetched_at', time.time())
+        if json_data is None:
+            return None
+        object.__setattr__(self, '_etag', etag)
+        return self._redmine.unwrap_json(self._type, json_data)
+
+    def _check_conflicts(self):
+        '''Raise RedmineConflictError if the item changed on the server.'''
+        if not self._item_path or not self.id:
+            return
+        known = self._peek('updated_on')
+        if known is None:
+            # Nothing to compare with
+            return
+        data = self._fetch_if_modified()
+        if data is None:
+            return
+        # The data isn't kept, so the ETag no longer matches what we have
+        object.__setattr__(self, '_etag', None)
+        if 'updated_on' not in data:
+            return
+        current = data['updated_on']
+        if isinstance(current, basestring):
+            current = parse_datetime(current)
+        if current != known:
+            raise RedmineConflictError(self, data)
 
     # do we need to muddy this up with a discard_changes?
 
 
+# Compact versions of the item classes, generated when first needed
+_compact_classes = {}
+
+# Internal attributes every compact item gets a slot for
+_compact_internal = ('_type', '_redmine', '_changes', '_tracking',
+                     '_originals', '_source_path', '_partial',
+                     '_known_fields', '_fault_group', '_fetched_at', '_etag',
+                     '_uncached', 'custom_fields')
+
+
+def compact_class(cls):
+    '''Returns a version of the given Redmine_Item class that keeps its
+    fields in __slots__ instead of a per-instance __dict__.
+
+    A slot is made for every data hint (class attribute set to None), every
+    field in _field_type and the internal attributes.  Any other field the
+    server sends is still stored, in a __dict__ created only when needed.
+    Unset slots read as the class default, exactly like the data hints.'''
+    try:
+        return _compact_classes[cls]
+    except KeyError:
+        pass
+    if getattr(cls, '_compact', False):
+        return cls
+
+    defaults = {}
+    for name in _compact_internal:
+        defaults[name] = getattr(cls, name, None)
+    for klass in reversed(cls.__mro__):
+        for name, value in vars(klass).items():
+            if (value is None or isinstance(value, _Field_Hint)) and \
+                    not name.startswith('_'):
+                defaults[name] = None
+        for name in getattr(klass, '_field_type', {}):
+            defaults.setdefault(name, getattr(cls, name, None))
+
+    # Date fields keep their value in a slot of their own
+    attributes = {}
+    for name in defaults.keys():
+        for klass in cls.__mro__:
+            if name in vars(klass):
+                if isinstance(vars(klass)[name], _Date_Field):
+                    slot = '_raw_' + name
+                    attributes[name] = _Date_Field(name, slot)
+                    del defaults[name]
+                    defaults[slot] = None
+                break
+
+    def __getattr__(self, name):
+        # Only called when a slot hasn't been set
+        if not name.startswith('_') and self._fault_in_field(name):
+            return getattr(self, name)
+        try:
+            return defaults[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    attributes.update({
+        '__slots__': tuple(sorted(defaults)),
+        '__module__': cls.__module__,
+        '__getattr__': __getattr__,
+        '_compact': True,
+    })
+    compact = type(cls)(cls.__name__, (cls,), attributes)
+    _compact_classes[cls] = compact
+    return compact
+
+
+def _index_key(value):
+    '''The key an item is indexed under for a field with the given value.
+    Items are indexed by their id, so project=1 finds what project.id == 1.'''
+    value = getattr(value, 'id', value)
+    if isinstance(value, dict):
+        value = value.get('id')
+    elif isinstance(value, basestring) and value.isdigit():
+        value = int(value)
+    return value
+
+
+class _Filter_Match(object):
+    '''Checks field values (as from _index_key) against one query filter.'''
+
+    def __init__(self, keys, negate=False, any=False):
+        # The accepted values, None when there's no such list
+        self.keys = None if (negate or any) else keys
+        self._keys = frozenset(keys)
+        self._negate = negate
+        self._any = any
+
+    def __call__(self, key):
+        if self._any:
+            return (key is not None) != self._negate
+        return (key in self._keys) != self._negate
+
+
+def _filter_matcher(value):
+    '''Returns a _Filter_Match for a filter value in Redmine's query syntax:
+    an id, several ids (1|2 or 1,2), any (*), none (!*) or none of (!1|2).
+    Returns None for anything else, such as 'me' or comparisons.'''
+    if isinstance(value, (list, tuple)):
+        value = '|'.join(unicode(_index_key(entry)) for entry in value)
+    else:
+        value = unicode(_index_key(value))
+    negate = value.startswith('!')
+    if negate:
+        value = value[1:]
+    if value == '*':
+        return _Filter_Match((), negate, any=True)
+    if not value or value == 'me' or value[0] in '<>=~':
+        return None
+    keys = [_index_key(part) for part in re.split('[|,]', value)]
+    return _Filter_Match(keys, negate)
+
+
+def _raw_getter(field):
+    '''Returns a function reading the given field from an item's data
+    exactly as the server sent it.'''
+    if field.startswith('cf_') and field[3:].isdigit():
+        field_id = int(field[3:])
+
+        def get_custom_field(data):
+            for custom_field in data.get('custom_fields', ()):
+                if custom_field.get('id') == field_id:
+                    return custom_field.get('value')
+            return None
+        return get_custom_field
+    return lambda data: data.get(field)
+
+
+def _data_getter(field):
+    '''Returns a function reading the given field from an item's data as
+    the server sent it, giving ids for fields that refer to other items.'''
+    if callable(field):
+        return field
+    if field.startswith('cf_') and field[3:].isdigit():
+        get_custom_field = _raw_getter(field)
+        return lambda data: _index_key(get_custom_field(data))
+    return lambda data: _index_key(data.get(field))
+
+
+def _numpy_columns(fields, types, columns):
+    '''Returns the columns made by query_columns as a NumPy structured array.'''
+    dtypes = {'int': 'i8', 'float': 'f8', 'date': 'M8[D]',
+              'datetime': 'M8[s]', 'object': 'O'}
+    length = len(columns[0]) if columns else 0
+    result = numpy.empty(length, dtype=[(str(field), dtypes[column_type])
+                                        for field, column_type
+                                        in zip(fields, types)])
+    for field, column_type, column in zip(fields, types, columns):
+        field = str(field)
+        if column_type == 'object':
+            values = numpy.empty(length, dtype='O')
+            for position, value in enumerate(column):
+                values[position] = value
+            result[field] = values
+            continue
+        values = numpy.frombuffer(column, dtype=column.typecode)
+        if column_type in ('date', 'datetime'):
+            missing = numpy.isnan(values)
+            values = numpy.where(missing, 0, values).astype('i8') \
+                .astype(dtypes[column_type])
+            values[missing] = numpy.datetime64('NaT')
+        result[field] = values
+    return result
+
+
+# Days are counted from here in date columns
+_epoch_ordinal = date(1970, 1, 1).toordinal()
+
+
+def _column_type(item_class, field):
+    '''Returns the kind of column query_columns makes for a field:
+    int, float, date, datetime or object.'''
+    if field == 'id':
+        return 'int'
+    if field.startswith('cf_'):
+        return 'object'
+    field_type = item_class._field_type.get(field)
+    if field_type in ('int', 'float', 'date', 'datetime'):
+        return field_type
+    if field_type or field in item_class._remap_to_id:
+        # Refers to another item, kept as its id
+        return 'int'
+    return 'object'
+
+
+def _column_value(column_type, value):
+    '''Converts a value as the server sent it for a column of the given type.
+    Missing ids and numbers are 0 and NaN, dates are days since 1970-01-01
+    and datetimes seconds since 1970-01-01 UTC, or NaN if missing.'''
+    if column_type == 'object':
+        return value
+    if value is None or value == '':
+        return 0 if column_type == 'int' else float('nan')
+    if column_type == 'int':
+        try:
+            return int(_index_key(value))
+        except (TypeError, ValueError):
+            return 0
+    if column_type == 'float':
+        return float(value)
+    if column_type == 'date':
+        return float(date(int(value[:4]), int(value[5:7]),
+                          int(value[8:10])).toordinal() - _epoch_ordinal)
+    value = parse_datetime(value)
+    return float(calendar.timegm(value.utctimetuple()))
+
+
+def _comparable(value):
+    '''Returns the value in a form that compares with other dates and times:
+    dates, and strings of them, become datetimes in UTC without a time zone.'''
+    if isinstance(value, basestring) and value[:4].isdigit() and \
+            value[4:5] == '-':
+        try:
+            value = parse_datetime(value)
+        except ValueError:
+            return value
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(_utc).replace(tzinfo=None)
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    return value
+
+
+def _filter_text(value):
+    '''Returns a value as written in a Redmine query filter.'''
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(_utc)
+        return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if isinstance(value, date):
+        return value.isoformat()
+    return unicode(_index_key(value))
+
+
+class _Predicate(object):
+    '''A test of an item, which can be combined with &, | and ~.'''
+
+    def __and__(self, other):
+        return _All_Of([self, other])
+
+    def __rand__(self, other):
+        return _All_Of([other, self])
+
+    def __or__(self, other):
+        return _Any_Of([self, other])
+
+    def __ror__(self, other):
+        return _Any_Of([other, self])
+
+    def __invert__(self):
+        return _Not(self)
+
+
+class _All_Of(_Predicate):
+    def __init__(self, predicates):
+        self.predicates = []
+        for predicate in predicates:
+            if isinstance(predicate, _All_Of):
+                self.predicates.extend(predicate.predicates)
+            else:
+                self.predicates.append(predicate)
+
+    def __call__(self, item):
+        return all(predicate(item) for predicate in self.predicates)
+
+
+class _Any_Of(_Predicate):
+    def __init__(self, predicates):
+        self.predicates = predicates
+
+    def __call__(self, item):
+        return any(predicate(item) for predicate in self.predicates)
+
+
+class _Not(_Predicate):
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def __call__(self, item):
+        return not self.predicate(item)
+
+
+# The operators the server's query filters take, by the kind of field
+_filter_operators = {
+    'reference': frozenset(['=', '!', '*', '!*']),
+    'date': frozenset(['=', '>=', '<=', '><', '*', '!*']),
+    'number': frozenset(['=', '>=', '<=', '><', '*', '!*']),
+    'text': frozenset(['=', '!', '~', '*', '!*']),
+    # Any format, so only what they all take
+    'custom': frozenset(['=', '*', '!*']),
+}
+
+
+def _field_kind(item_class, field):
+    '''Returns the kind of a field of the given item class,
+    as in _filter_operators.'''
+    if field.startswith('cf_') and field[3:].isdigit():
+        return 'custom'
+    field_type = item_class._field_type.get(field)
+    if field_type in ('date', 'datetime'):
+        return 'date'
+    if field_type in ('float', 'int'):
+        return 'number'
+    if field_type or field in item_class._schema.remap:
+        return 'reference'
+    return 'text'
+
+
+class Field_Condition(_Predicate):
+    '''A condition on one field of an item, made from a Field.
+    It can be sent to the server as a query filter, or checked on an item.'''
+
+    def __init__(self, field, operator, values=()):
+        self.field = field
+        self.operator = operator
+        self.values = list(values)
+
+    def __or__(self, other):
+        # (status == 1) | (status == 2) is status_id=1|2
+        if isinstance(other, Field_Condition) and other.field == self.field \
+                and self.operator == other.operator == '=':
+            return Field_Condition(self.field, '=', self.values + other.values)
+        return _Predicate.__or__(self, other)
+
+    def __invert__(self):
+        opposite = {'=': '!', '!': '=', '*': '!*', '!*': '*'}.get(self.operator)
+        if opposite:
+            return Field_Condition(self.field, opposite, self.values)
+        return _Predicate.__invert__(self)
+
+    def _combine(self, other):
+        '''Returns one condition for this and another on the same field,
+        or None if there isn't one.'''
+        bounds = {self.operator: self, other.operator: other}
+        if len(bounds) == 2 and '>=' in bounds and '<=' in bounds:
+            return Field_Condition(self.field, '><', bounds['>='].values +
+                                   bounds['<='].values)
+        return None
+
+    def _parameter(self, item_class):
+        '''Returns the name of the query filter for this condition on items
+        of the given class, or None if the server can't check it.'''
+        if self.operator not in _filter_operators[
+                _field_kind(item_class, self.field)]:
+            return None
+        if self.operator in ('=', '!') and not self.values:
+            return None
+        query_filters = item_class._query_filters
+        if self.field.startswith('cf_') and self.field[3:].isdigit():
+            parameter = query_filters.get('custom_fields')
+            return parameter and parameter % self.field[3:]
+        return query_filters.get(self.field)
+
+    def _filter_value(self):
+        '''Returns the condition written as a query filter value.'''
+        values = [_filter_text(value) for value in self.values]
+        if self.operator in ('*', '!*'):
+            return self.operator
+        if self.operator == '=':
+            return '|'.join(values)
+        return self.operator + '|'.join(values)
+
+    def _value(self, item):
+        if self.field.startswith('cf_') and self.field[3:].isdigit():
+            try:
+                value = item.custom_fields[int(self.field[3:])]
+            except (AttributeError, KeyError):
+                return None
+            return value or None
+        return getattr(item, self.field, None)
+
+    def __call__(self, item):
+        value = _comparable(_index_key(self._value(item)))
+        operator = self.operator
+        if operator == '*':
+            return value is not None
+        if operator == '!*':
+            return value is None
+        if operator == '~':
+            return value is not None and \
+                self.values[0].lower() in unicode(value).lower()
+        values = [_comparable(_index_key(entry)) for entry in self.values]
+        if operator == '=':
+            return value in values
+        if operator == '!':
+            return value not in values
+        if value is None:
+            return False
+        if operator == '>=':
+            return value >= values[0]
+        if operator == '<=':
+            return value <= values[0]
+        if operator == '>':
+            return value > values[0]
+        if operator == '<':
+            return value < values[0]
+        if operator == '><':
+            return values[0] <= value <= values[1]
+        raise ValueError('Unknown operator %r.' % operator)
+
+
+class Field(object):
+    '''Names a field of the items in a query, to write conditions on it:
+
+    >>> from redmine import Field
+    >>> server.issues.where(Field('tracker') == 1,
+    ...                     Field('due_date') <= date(2013, 3, 1))
+
+    Conditions on fields the server can filter by are sent with the query
+    when the server has the operator for that kind of field (ranges only on
+    dates and numbers, contains only on text), the rest are checked on
+    each item as it arrives.  Fields that refer to
+    other items (status, tracker, assigned_to...) compare by id.  Custom
+    fields are named cf_<id>.'''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __eq__(self, value):
+        return Field_Condition(self.name, '=', [value])
+
+    def __ne__(self, value):
+        return Field_Condition(self.name, '!', [value])
+
+    def __ge__(self, value):
+        return Field_Condition(self.name, '>=', [value])
+
+    def __le__(self, value):
+        return Field_Condition(self.name, '<=', [value])
+
+    def __gt__(self, value):
+        return Field_Condition(self.name, '>', [value])
+
+    def __lt__(self, value):
+        return Field_Condition(self.name, '<', [value])
+
+    def is_in(self, values):
+        return Field_Condition(self.name, '=', values)
+
+    def between(self, low, high):
+        return Field_Condition(self.name, '><', [low, high])
+
+    def contains(self, text):
+        return Field_Condition(self.name, '~', [text])
+
+    def is_set(self):
+        return Field_Condition(self.name, '*')
+
+    def is_none(self):
+        return Field_Condition(self.name, '!*')
+
+
+class Cache_Index(object):
+    '''Finds the cached items of one type by the value of one field.
+
+    Kept up to date as data from the server is stored in the items, and as
+    items are saved.  Fields that refer to other items are indexed by the
+    id of the item they refer to.'''
+
+    def __init__(self, field):
+        self.field = field
+        # key -> set of item ids
+        self.entries = {}
+        # item id -> key
+        self.keys = {}
+
+    def update(self, id, value):
+        '''Index the item with the given id under the given field value.'''
+        key = _index_key(value)
+        try:
+            hash(key)
+        except TypeError:
+            # Lists and the like can't be looked up
+            key = None
+        old = self.keys.get(id, _missing)
+        if old == key:
+            return
+        if old is not _missing:
+            self.entries[old].discard(id)
+            if not self.entries[old]:
+                del self.entries[old]
+        self.keys[id] = key
+        self.entries.setdefault(key, set()).add(id)
+
+    def remove(self, id):
+        '''Forget the item with the given id.'''
+        key = self.keys.pop(id, _missing)
+        if key is not _missing:
+            self.entries[key].discard(id)
+            if not self.entries[key]:
+                del self.entries[key]
+
+    def ids(self, value):
+        '''Returns the ids of the items with the given field value.'''
+        return self.entries.get(_index_key(value), frozenset())
+
+
+class Custom_Field_Layout(object):
+    '''The ids and names of a set of custom fields, in the order Redmine sent them.
+    Every item with the same custom fields shares one layout.'''
+    __slots__ = ('ids', 'names', '_index')
+
+    def __init__(self, ids, names):
+        self.ids = ids
+        self.names = names
+        self._index = None
+
+    @property
+    def index(self):
+        '''Maps both the id and the name of each field to its position.
+        Only built when first needed.'''
+        if self._index is None:
+            index = {}
+            for position, name in enumerate(self.names):
+                if name is not None:
+                    index[name] = position
+            for position, id in enumerate(self.ids):
+                index[id] = position
+            self._index = index
+        return self._index
+
+
+class Custom_Field_Definitions(object):
+    '''The custom fields seen on one Redmine server.
+    Each distinct set of custom fields is kept once as a Custom_Field_Layout,
+    and each field name string is kept once across all of them.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._names = {}
+        self._layouts = {}
+
+    def layout(self, custom_field_data):
+        '''Returns the shared layout for the given list of custom field dicts.'''
+        key = tuple((field['id'], field.get('name'))
+                    for field in custom_field_data)
+        try:
+            return self._layouts[key]
+        except KeyError:
+            pass
+        with self._lock:
+            names = tuple(self._names.setdefault(name, name)
+                          for id, name in key)
+            ids = tuple(id for id, name in key)
+            return self._layouts.setdefault(key, Custom_Field_Layout(ids, names))
+
+    def name(self, id):
+        '''Returns the name of the custom field with the given id, or None.'''
+        for layout in self._layouts.values():
+            try:
+                return layout.names[layout.ids.index(id)]
+            except ValueError:
+                continue
+        return None
+
+
 class Custom_Fields(object):
     '''Custom fields attached to a Redmine item.
     This behaves somewhat like a dictionary, but the custom field can be accessed by either name or ID.
     For instance, if your custom field is called "The Client" and Redmine has assigned that field
     the ID of 4, then you can check the value of that field by using (item).custom_fields[4] or
     (item).custom_fields['The Client'].  You can assign a new value by simply assigning the value:
-    (item).custom_fields['The Client'] = 'John Cleese' or (item).custom_fields[4] = 'John Cleese' '''
-    changed = False
-
-    def __init__(self, custom_field_data):
-        self._get_ref = {}
-        self._data = custom_field_data
+    (item).custom_fields['The Client'] = 'John Cleese' or (item).custom_fields[4] = 'John Cleese'
+
+    The field ids and names are kept in a layout shared with other items
+    (see Custom_Field_Definitions), only the values are kept here. '''
+    __slots__ = ('_layout', '_values', '_originals', 'changed')
+
+    def __init__(self, custom_field_data, definitions=None):
+        if definitions is None:
+            definitions = Custom_Field_Definitions()
+        self._layout = definitions.layout(custom_field_data)
+        self._values = [field.get('value') for field in custom_field_data]
+        # Position -> value before the first change, once changed
+        self._originals = None
+        self.changed = False
 
-        # Map the field data to easy-to-access dicts
-        for field in custom_field_data:
-            self._get_ref[field['id']] = field
-            try:
-                self._get_ref[field['name']] = field
-            except KeyError:
-                pass
+    @property
+    def _data(self):
+        '''The custom fields as the list of dicts Redmine sent.'''
+        return [{'id': id, 'name': name, 'value': value}
+                for id, name, value in zip(self._layout.ids,
+                                           self._layout.names,
+                                           self._values)]
 
     def __repr__(self):
         return '<Custom Fields: %s>' % self._data
 
     def _get_all(self):
         '''Return all values.'''
-        return dict( (f['id'], f.get('value','')) for f in self._data )
+        return dict( (id, '' if value is None else value)
+                     for id, value in zip(self._layout.ids, self._values) )
 
     def _get_changes(self):
-        '''Get all changed values.'''
-        result = dict( (f['id'], f.get('value','')) for f in self._data if f.get('changed', False) )
-        self._clear_changes
+        '''Get all changed values, leaving out any set back to their original value.'''
+        result = {}
+        for position, original in (self._originals or {}).iteritems():
+            value = self._values[position]
+            if value != original:
+                result[self._layout.ids[position]] = '' if value is None else value
         return result
 
     def _clear_changes(self):
         '''Reset the changed flags'''
         self.changed = False
-        for f in self._data:
-            del(f['changed'])
+        self._originals = None
 
     def __getitem__(self, key):
         # returned when self[key] is called
-        return self._get_ref[key].get('value', None)
+        return self._values[self._layout.index[key]]
 
     def __setitem__(self, key, value):
         # returned when self[key]=value
-        field = self._get_ref[key]
-        field['value'] = value
-        field['changed'] = True
+        position = self._layout.index[key]
+        if self._originals is None:
+            self._originals = {}
+        self._originals.setdefault(position, self._values[position])
+        self._values[position] = value
         self.changed = True
 
+    def _keep_changes(self, previous):
+        '''Put the unsaved changes of previous (these custom fields before
+        new data arrived) back on top of the new values.'''
+        for position in (previous._originals or {}):
+            try:
+                self[previous._layout.ids[position]] = previous._values[position]
+            except KeyError:
+                # No longer sent by the server
+                pass
+
 
 class Redmine_Items_Manager(object):
     '''Manage items within Redmine.
@@ -379,6 +1684,12 @@ class Redmine_Items_Manager(object):
     Create a new item:
     MANAGER.new(key='value', key2='value2', ...)
 
+    Create many items from any iterable of dicts, several at a time:
+    MANAGER.new_many(records)
+
+    Create items in the background, without waiting for the server:
+    MANAGER.write_behind().put(key='value', key2='value2', ...)
+
     Get Item
     --------
     Items can be retreived by accessing as if it were a dictionary:
@@ -388,6 +1699,9 @@ class Redmine_Items_Manager(object):
     >>> proj = server.projects['test-project']
     >>> proj = server.projects[10]
 
+    Related data can be fetched along with the item:
+    >>> issue = server.issues.get(10, include=['journals', 'attachments'])
+
     Delete
     ------
     Delete an item:
@@ -421,10 +1735,16 @@ class Redmine_Items_Manager(object):
     * assigned_to_id: get issues which are assigned to the given user id
     * cf_x: get issues with the given value for custom field with an ID of x. (Custom field must have 'used as a filter' checked.)
 
+    Conditions can also be written in Python, and those the server can
+    check are sent as filters (see Field):
+    >>> for issue in MANAGER.where(Field('due_date') <= date(2013, 3, 1)):
+    ...    print issue
+
     Any query can be returned as a list or a dictionary as well:
     MANAGER.query_to_list(<optional filter>)
     MANAGER.query_to_dict(<optional filter>)
     The full query is run, and no data is returned until the query is complete which may require multiple calls to Redmine.
+    For very large results, pass spill_threshold to keep only that many items in memory, and the rest on disk.
 
     For instance, to print all the issues associated with a project, you can use:
 
@@ -447,8 +1767,11 @@ class Redmine_Items_Manager(object):
 
     _update_path = ''
 
-    def __init__(self, redmine, item_obj=None, query_path=None, item_path=None, item_new_path=None):
+    def __init__(self, redmine, item_obj=None, query_path=None, item_path=None, item_new_path=None, scope=None):
         self._redmine = redmine
+        # The filters every query of this manager has, such as
+        # {'project_id': 1} for project.issues
+        self._scope = scope or {}
 
         if item_obj:
             self._object = item_obj
@@ -492,16 +1815,77 @@ class Redmine_Items_Manager(object):
             obj = iter.next()
             yield (obj.id, obj)
 
-    def query_to_dict(self, **options):
-        '''Run a query and return all results as a dictionary'''
-        return dict(self.iteritems(**options))
-
-    def query_to_list(self, **options):
-        '''Run a query and return all results as a list'''
-        return list(self.query(**options))
-
-    def _objectify(self, json_data=None, data={}):
-        '''Return an object derived from the given json data.'''
+    def query_to_dict(self, spill_threshold=None, **options):
+        '''Run a query and return all results as a dictionary
+
+        With spill_threshold, only that many items are kept, the rest is
+        kept on disk and returned in a Spilled_Dict (see query_to_list).'''
+        if spill_threshold is None:
+            return dict(self.iteritems(**options))
+        items, spill = self._spilled_query(spill_threshold, options)
+        return Spilled_Dict(self, items, spill)
+
+    def query_to_list(self, spill_threshold=None, **options):
+        '''Run a query and return all results as a list
+
+        With spill_threshold, only that many items are made up front.  The
+        data for the rest is kept in a temporary file, and each of those
+        items is made from it when it is accessed, without being cached.
+        A Spilled_List is returned, which can be indexed and iterated over
+        like a list.  The options are the same as for query, and a query
+        answered from the cache has nothing to spill.'''
+        if spill_threshold is None:
+            return list(self.query(**options))
+        items, spill = self._spilled_query(spill_threshold, options)
+        return Spilled_List(self, items, spill)
+
+    def _spilled_query(self, spill_threshold, options):
+        '''Runs a query as query does, returns the first spill_threshold
+        items, and a _Spill_File with the data of the others.'''
+        spill = _Spill_File()
+        items = self._replica_query(options)
+        if items is not None:
+            # Cached already, nothing to spill
+            spill.finish()
+            return items, spill
+        if not self._query_path:
+            raise AttributeError('query is not available for %s' % self._item_name)
+        prefetch_related = options.pop('prefetch_related', None)
+        workers = options.pop('workers', 1)
+        items = []
+        for data_container in self._pages(options, workers):
+            room = max(0, spill_threshold - len(items))
+            if room:
+                page = self._page_items(data_container[:room])
+                if prefetch_related:
+                    self.prefetch_related(page, *prefetch_related)
+                items.extend(page)
+            for entry in data_container[room:]:
+                spill.append(entry)
+        spill.finish()
+        return items, spill
+
+    def _spilled_item(self, data):
+        '''Returns the item for data that was spilled to disk: the cached
+        item if there is one, otherwise a new item that isn't cached
+        (nor listed in the cache indexes).'''
+        redmine = self._redmine
+        with redmine._cache_lock:
+            try:
+                return redmine.item_cache[self._item_type][data['id']]
+            except KeyError:
+                pass
+        item_class = self._object
+        if redmine.compact:
+            item_class = compact_class(item_class)
+        item = item_class(redmine=redmine, type=self._item_type)
+        object.__setattr__(item, '_uncached', True)
+        item._update_data(data)
+        return item
+
+    def _objectify(self, json_data=None, data={}, partial=False):
+        '''Return an object derived from the given json data.
+        New items are marked partial if the data is only a summary.'''
         if json_data:
             # Parse the data
             try:
@@ -517,16 +1901,16 @@ class Redmine_Items_Manager(object):
             pass
 
         # Either returns a new item or updates the item in the cache and returns that
-        return self._redmine.check_cache(self._item_type, data, self._object)
+        return self._redmine.check_cache(self._item_type, data, self._object,
+                                         partial)
 
     def new(self, **dict):
         '''Create a new item with the provided dict information.  Returns the new item.'''
         if not self._item_new_path:
             raise AttributeError('new is not available for %s' % self._item_name)
 
-        # Remap various tag to tag_id
-        for tag in self._object._remap_to_id:
-            self._object._remap_tag_to_tag_id(tag, dict)
+        # Remap various tag to tag_id, convert dates
+        self._object._schema.encode(dict, self._redmine)
 
         target = self._item_new_path
         payload = json.dumps({self._item_type:dict})
@@ -535,15 +1919,107 @@ class Redmine_Items_Manager(object):
         data['_source_path'] = target
         return self._objectify(data=data)
 
-    def get(self, id, **options):
-        '''Get a single item with the given ID'''
+    def new_many(self, records, workers=None, checkpoint=None, chunk_size=None):
+        '''Create an item for each dict in records, which can be any iterable
+        (such as a csv.DictReader).  Returns the new items in input order.
+
+        Records are read a chunk at a time and created with up to workers
+        requests at once.  If any fail, the remaining chunks are not started
+        and a Bulk_Create_Error is raised.  Its checkpoint, a plain dict that
+        can be saved as JSON, resumes the work when given back along with the
+        same records in the same order:
+
+        >>> try:
+        ...     entries = server.time_entries.new_many(csv.DictReader(f))
+        ... except Bulk_Create_Error, e:
+        ...     f.seek(0)
+        ...     entries = server.time_entries.new_many(csv.DictReader(f),
+        ...                                            checkpoint=e.checkpoint)
+
+        Only records that weren't created before are sent on resume.'''
+        workers = workers or self._redmine.workers
+        chunk_size = chunk_size or workers * 4
+
+        position = 0
+        retry = set()
+        if checkpoint:
+            position = checkpoint['position']
+            retry = set(checkpoint['failed'])
+
+        # Failed records of the checkpoint that were sent again
+        retried = set()
+
+        def pending():
+            for index, record in enumerate(records):
+                if index >= position or index in retry:
+                    if index in retry:
+                        retried.add(index)
+                    yield index, record
+
+        def create((index, record)):
+            return self.new(**record)
+
+        created = []
+        errors = {}
+        pending = pending()
+        while not errors:
+            chunk = list(islice(pending, chunk_size))
+            if not chunk:
+                break
+            results = run_concurrently(create, chunk, workers)
+            for (index, record), (item, error) in zip(chunk, results):
+                if error is None:
+                    created.append(item)
+                else:
+                    errors[index] = error
+            position = max(position, chunk[-1][0] + 1)
+
+        if errors:
+            # Failures not retried this time still have to be
+            failed = set(errors) | (retry - retried)
+            raise Bulk_Create_Error(created, errors,
+                                    {'position': position,
+                                     'failed': sorted(failed)})
+        return created
+
+    def write_behind(self, **options):
+        '''Returns a Write_Behind_Queue creating items in the background.
+        Options are passed to the Write_Behind_Queue.
+
+        The same queue is returned until it is closed.  Its options can't
+        be changed meanwhile: giving different ones raises a ValueError
+        (giving none is fine).'''
+        if not self._item_new_path:
+            raise AttributeError('new is not available for %s' % self._item_name)
+        queue = getattr(self, '_write_behind', None)
+        if queue is None or queue.closed:
+            queue = self._write_behind = Write_Behind_Queue(self, **options)
+            self._write_behind_options = options
+        elif options and options != self._write_behind_options:
+            raise ValueError('The write behind queue is already open with '
+                             'other options, close it first.')
+        return queue
+
+    def get(self, id, include=None, **options):
+        '''Get a single item with the given ID.
+
+        Related data can be requested in the same call with include, such as
+        include=['journals', 'children', 'relations', 'attachments', 'watchers']
+        for issues.  The related data is turned into items as well.'''
         if not self._item_path:
             raise AttributeError('get is not available for %s' % self._item_name)
+        if include:
+            options['parms'] = dict(options.get('parms') or {},
+                                    include=_include_parameter(include))
         target = self._item_path % id
         json_data = self._redmine.get(target, **options)
         data = self._redmine.unwrap_json(self._item_type, json_data)
         data['_source_path'] = target
-        return self._objectify(data=data)
+        item = self._objectify(data=data)
+        # We have all of it now
+        object.__setattr__(item, '_partial', False)
+        object.__setattr__(item, '_fetched_at', time.time())
+        return item
 
     def update(self, id, **dict):
         '''Update a given item with the passed data.'''
@@ -560,56 +2036,1043 @@ class Redmine_Items_Manager(object):
             raise AttributeError('delete is not available for %s' % self._item_name)
         target = self._item_path % id
         self._redmine.delete(target)
+        self._redmine.forget(self._item_type, id)
         return None
 
+    def where(self, *predicates, **options):
+        '''Return an iterator for the items meeting all the given conditions,
+        made with Field (see there), or any function of an item:
+
+        >>> server.issues.where(Field('status') == 'closed',
+        ...                     Field('assigned_to').is_in([5, 7]),
+        ...                     lambda issue: 'urgent' in issue.subject)
+
+        Conditions the server can check are sent as query filters, so only
+        matching items are downloaded.  The rest are checked here, such as
+        ranges on fields that refer to other items.  Any other options are
+        passed to query as is.  A field that is_in an empty list matches
+        nothing, without asking the server.'''
+        pushed = {}
+        remaining = []
+        for predicate in _All_Of(predicates).predicates:
+            parameter = None
+            if isinstance(predicate, Field_Condition):
+                if predicate.operator == '=' and not predicate.values:
+                    return iter(())
+                parameter = predicate._parameter(self._object)
+            if not parameter or parameter in options:
+                remaining.append(predicate)
+            elif parameter in pushed:
+                combined = pushed[parameter]._combine(predicate)
+                if combined is None:
+                    remaining.append(predicate)
+                else:
+                    pushed[parameter] = combined
+            else:
+                pushed[parameter] = predicate
+        for parameter, condition in pushed.iteritems():
+            options[parameter] = condition._filter_value()
+
+        items = self.query(**options)
+        if not remaining:
+            return items
+        return (item for item in items
+                if all(predicate(item) for predicate in remaining))
+
+    def add_index(self, field):
+        '''Index the cached items by the given field, for cached.
+
+        >>> server.issues.add_index('assigned_to')'''
+        return self._redmine.add_index(self._item_type, field)
+
+    def cached(self, **filters):
+        '''Return the cached items whose fields have the given values,
+        without asking the server.  Items are given by id or as items:
+
+        >>> server.issues.cached(assigned_to=7, status=1)
+
+        Indexed fields are looked up in their index (see add_index),
+        others are compared item by item.  Fields may also be given as
+        their id (assigned_to_id=7).'''
+        redmine = self._redmine
+        indexes = redmine._indexes.get(self._item_type, {})
+        with redmine._cache_lock:
+            cache = redmine.item_cache.get(self._item_type, {})
+            ids = None
+            unindexed = []
+            for name, value in filters.iteritems():
+                field = name
+                if name not in indexes and name.endswith('_id') and \
+                        name not in self._object._schema.fields:
+                    field = name[:-3]
+                if field in indexes:
+                    found = indexes[field].ids(value)
+                    ids = set(found) if ids is None else ids & found
+                else:
+                    unindexed.append((field, _index_key(value)))
+            if ids is None:
+                items = cache.values()
+            else:
+                items = [cache[id] for id in ids if id in cache]
+        for field, key in unindexed:
+            items = [item for item in items
+                     if _index_key(item._peek(field)) == key]
+        return sorted(items, key=lambda item: item.id)
+
+    def prefetch_related(self, items, *fields):
+        '''Fetch the full details of the items that the given fields of the
+        given items refer to, using as few requests as possible.
+        For instance, to get every user an issue is assigned to:
+
+        >>> server.issues.prefetch_related(issues, 'assigned_to')
+
+        Returns a dict of {(type, id): error} for any that couldn't be fetched.'''
+        ids_by_type = {}
+        for field in fields:
+            item_type = self._object._field_type.get(field, field)
+            ids = ids_by_type.setdefault(item_type, set())
+            for item in items:
+                related = item._peek(field)
+                if getattr(related, '_partial', False):
+                    ids.add(related.id)
+
+        errors = {}
+        for item_type, ids in ids_by_type.iteritems():
+            for id, error in self._redmine.fetch_items(item_type, ids).iteritems():
+                errors[(item_type, id)] = error
+        return errors
+
     def query(self, **options):
-        '''Return an iterator for the given items.'''
+        '''Return an iterator for the given items.
+
+        If prefetch_related is given a list of fields (ie: ['assigned_to',
+        'author']) the items those fields refer to are fetched for a whole
+        page at once, before any item of that page is returned.
+
+        Related data can be requested with include, as with get.
+
+        With workers, up to that many pages are fetched at once after the
+        first one.  For very large queries, see scan.
+
+        When the cache holds every item of this type (see
+        Redmine.mark_replica_current), queries using only the filters listed
+        above are answered from the cache, newest id first, without asking
+        the server.'''
+        items = self._replica_query(options)
+        if items is not None:
+            return iter(items)
+        return self._server_query(**options)
+
+    def _replica_query(self, options):
+        '''Returns the items answering the query from the cache if it holds
+        every item of this type, or None if the server has to be asked.'''
+        # Managers with their own query path need a scope to stand for it
+        if self._item_type in self._redmine._replicas and \
+                (self._scope or self._query_path == self._object._query_path):
+            return self._local_query(options)
+        return None
+
+    def _local_query(self, options):
+        '''Returns the cached items matching the query options, or None if
+        the options can't all be checked locally.'''
+        filters = dict(self._object._default_filters)
+        filters.update(self._scope)
+        for name, value in options.iteritems():
+            if name not in ('limit', 'offset', 'workers', 'prefetch_related'):
+                filters[name] = value
+
+        redmine = self._redmine
+        indexes = redmine._indexes.get(self._item_type, {})
+        tests = []
+        candidates = None
+        for name, value in filters.iteritems():
+            local_filter = self._local_filter(name, value, filters)
+            if local_filter is None:
+                return None
+            field, keys, test = local_filter
+            if field in indexes and keys is not None:
+                # Start from the index instead of every cached item
+                found = set()
+                for key in keys:
+                    found.update(indexes[field].ids(key))
+                candidates = found if candidates is None else candidates & found
+            tests.append(test)
+
+        with redmine._cache_lock:
+            cache = redmine.item_cache.get(self._item_type, {})
+            if candidates is None:
+                items = cache.values()
+            else:
+                items = [cache[id] for id in candidates if id in cache]
+        items = [item for item in items
+                 if all(test(item) for test in tests)]
+        items.sort(key=lambda item: item.id, reverse=True)
+        redmine.count_avoided_request()
+        return items
+
+    def _local_filter(self, name, value, filters):
+        '''Returns (field, keys, test) to check a query filter against cached
+        items, where keys are the field values it accepts if it's a plain
+        list of them, or None if the filter can't be checked locally.'''
+        redmine = self._redmine
+        fields = self._object._schema.fields
+        match = _filter_matcher(value)
+        if match is None:
+            return None
+
+        if name.startswith('cf_') and name[3:].isdigit():
+            field_id = int(name[3:])
+
+            def test(item):
+                try:
+                    value = item._peek('custom_fields')[field_id]
+                except (TypeError, KeyError):
+                    value = None
+                if isinstance(value, list):
+                    return any(match(_index_key(entry)) for entry in value) or \
+                        (not value and match(None))
+                return match(_index_key(value or None))
+            return name, None, test
+
+        if name == 'subproject_id':
+            # Checked along with project_id
+            if 'project_id' not in filters:
+                return None
+            return name, None, lambda item: True
+
+        if name == 'project_id':
+            projects = self._local_projects(value, filters.get('subproject_id'))
+            if projects is None:
+                return None
+            return 'project', projects, \
+                lambda item: _index_key(item._peek('project')) in projects
+
+        if name == 'status_id' and unicode(value) in ('open', 'closed'):
+            try:
+                closed = set(status.id for status in
+                             redmine.enumerations.items('status')
+                             if status._peek('is_closed'))
+            except KeyError:
+                return None
+            want_closed = unicode(value) == 'closed'
+            return 'status', None, lambda item: \
+                (_index_key(item._peek('status')) in closed) == want_closed
+
+        if name in fields:
+            field = name
+        elif name.endswith('_id') and name[:-3] in fields:
+            field = name[:-3]
+        else:
+            return None
+        return field, match.keys, \
+            lambda item: match(_index_key(item._peek(field)))
+
+    def _local_projects(self, project, subprojects=None):
+        '''Returns the ids of the cached projects a project_id filter covers,
+        or None if that can't be worked out from the cache.'''
+        redmine = self._redmine
+        with redmine._cache_lock:
+            projects = redmine.item_cache.get('project', {}).values()
+        project_id = _index_key(project)
+        if not isinstance(project_id, (int, long)):
+            # Given by identifier
+            for item in projects:
+                if item._peek('identifier') == project_id:
+                    project_id = item.id
+                    break
+            else:
+                return None
+        covered = set([project_id])
+        subprojects = unicode(subprojects) if subprojects is not None else '*'
+        if subprojects == '!*':
+            return covered
+        if subprojects != '*':
+            match = _filter_matcher(subprojects)
+            if match is None or match.keys is None:
+                return None
+            return covered | set(match.keys)
+
+        # Subprojects are included, which needs every project to be cached
+        if 'project' not in redmine._replicas:
+            return None
+        children = {}
+        for item in projects:
+            parent = _index_key(item._peek('parent'))
+            if parent is not None:
+                children.setdefault(parent, []).append(item.id)
+        pending = [project_id]
+        while pending:
+            for child in children.get(pending.pop(), ()):
+                if child not in covered:
+                    covered.add(child)
+                    pending.append(child)
+        return covered
+
+    def _server_query(self, **options):
+        '''Runs the query on the server, see query.'''
         if not self._query_path:
             raise AttributeError('query is not available for %s' % self._item_name)
-        last_item = 0
-        offset = 0
-        current_item = None
+        prefetch_related = options.pop('prefetch_related', None)
+        workers = options.pop('workers', 1)
+        for data_container in self._pages(options, workers):
+            items = self._page_items(data_container)
+            if prefetch_related:
+                self.prefetch_related(items, *prefetch_related)
+            for item in items:
+                yield item
+
+    def _page_items(self, data_container):
+        '''Returns the items for one page of query results.'''
+        # Lists only give a summary of each item, the rest of an
+        # item's fields are fetched for the whole page when first read
+        items = [self._objectify(data=item_data, partial=True)
+                 for item_data in data_container]
+        partial = [item for item in items
+                   if getattr(item, '_partial', False)]
+        group = frozenset(item.id for item in partial)
+        for item in partial:
+            object.__setattr__(item, '_fault_group', group)
+        return items
+
+    def _fetch_page(self, options, offset):
+        '''Returns the decoded query results at the given offset.'''
+        options = dict(options, offset=offset)
+        json_data = self._redmine.get(self._query_path, options)
+        # Try and read the json
+        try:
+            return json.loads(json_data)
+        except:
+            raise RedmineError(json_data)
+
+    def _pages(self, options, workers=1, offset=0):
+        '''Yields the list of item data from each page of a query, in order,
+        starting from the given offset.
+        With more than one worker, once the first page tells how many items
+        there are, the other pages are fetched up to workers at a time.'''
+        options = dict(options)
+        if options.get('include'):
+            options['include'] = _include_parameter(options['include'])
         limit = options.get('limit', 25)
         options['limit'] = limit
-        target = self._query_path
         while True:
-            options['offset'] = offset
             # go get the data with the given offset
-            json_data = self._redmine.get(target, options)
-            # Try and read the json
-            try:
-                data = json.loads(json_data)
-            except:
-                raise RedmineError(json_data)
+            data = self._fetch_page(options, offset)
 
             # The data is enclosed in the _query_container item
             # That is, {'issues':{(issue1),(issue2)...}, 'total_count':##}
             data_container = data[self._query_container]
-            for item_data in data_container:
-                yield(self._objectify(data=item_data))
+            yield data_container
 
             # If the container was empty, we requested past the end, just exit
             if not data_container:
-                break
+                return
             try:
-                if int(data['total_count']) > ( offset + len(data_container) ):
-                    # moar data!
-                    offset += limit
-                else:
-                    break
+                total_count = int(data['total_count'])
             except:
                 # If we don't even have a 'total_count', we're done.
+                return
+            if total_count <= offset + len(data_container):
+                return
+            # moar data!
+            offset += limit
+            if workers > 1:
                 break
 
+        # The rest of the pages, several at a time
+        offsets = range(offset, total_count, limit)
+        for start in range(0, len(offsets), workers):
+            results = run_concurrently(
+                lambda offset: self._fetch_page(options, offset),
+                offsets[start:start + workers], workers)
+            for data, error in results:
+                if error is not None:
+                    raise error
+                yield data[self._query_container]
+
+    def aggregate(self, by, sum=None, workers=None, **options):
+        '''Run a query and total a field for each distinct value of others.
+        Only the running totals are kept, page by page, so it takes little
+        memory however many items match:
+
+        >>> server.time_entries.aggregate(by=['user', 'activity'], sum='hours',
+        ...                               spent_on='><2013-01-01|2013-01-31')
+        {(5, 9): 12.5, (6, 9): 3.0, ...}
+
+        by is a field, or a list of them giving tuples as keys.  Fields that
+        refer to other items give their id.  Custom fields are named cf_<id>,
+        and any function of an item's data may be given instead of a field,
+        ie: lambda entry: entry['spent_on'][:7] for the month.
+        Without sum, the items are counted.  With workers, up to that many
+        pages are fetched at once.  The other options filter the query.'''
+        # sum is the name callers use, keep the builtin available here
+        sum_field = sum
+        if not self._query_path:
+            raise AttributeError('query is not available for %s' % self._item_name)
+        single = isinstance(by, basestring) or callable(by)
+        getters = [_data_getter(field) for field in ([by] if single else by)]
+        totals = {}
+        for data_container in self._pages(options, workers or 1):
+            for entry in data_container:
+                key = tuple(get(entry) for get in getters)
+                if single:
+                    key = key[0]
+                if sum_field is None:
+                    value = 1
+                else:
+                    value = entry.get(sum_field) or 0
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def query_columns(self, fields, as_numpy=None, workers=None, **options):
+        '''Run a query and return the given fields of every item as columns,
+        one compact array per field, ready for numeric work:
+
+        >>> columns = server.time_entries.query_columns(
+        ...     ['id', 'user', 'hours', 'spent_on'], project_id=1)
+        >>> sum(columns['hours'])
+
+        ids and fields that refer to other items (as their id) are int
+        columns, float fields are float columns, and the rest are lists.
+        Dates are float columns of days since 1970-01-01, and datetimes of
+        seconds since then in UTC.  Missing numbers and dates are NaN,
+        missing ids are 0.
+
+        The columns are array.array, in a dict by field name.  With
+        as_numpy (the default when NumPy is installed) a NumPy structured
+        array is returned instead, with the dates as datetime64 and missing
+        ones as NaT.  With workers, up to that many pages are fetched at
+        once.  The other options filter the query.'''
+        if not self._query_path:
+            raise AttributeError('query is not available for %s' % self._item_name)
+        if as_numpy is None:
+            as_numpy = numpy is not None
+        elif as_numpy and numpy is None:
+            raise RedmineError('NumPy is not installed.')
+
+        types = [_column_type(self._object, field) for field in fields]
+        columns = []
+        for column_type in types:
+            if column_type == 'object':
+                columns.append([])
+            else:
+                columns.append(array('l' if column_type == 'int' else 'd'))
+        getters = [_raw_getter(field) for field in fields]
+        for data_container in self._pages(options, workers or 1):
+            for entry in data_container:
+                for get, column_type, column in zip(getters, types, columns):
+                    column.append(_column_value(column_type, get(entry)))
+
+        if not as_numpy:
+            return dict(zip(fields, columns))
+        return _numpy_columns(fields, types, columns)
+
+    def scan(self, partition_by, partitions=None, workers=None, **options):
+        '''Return an iterator for the items of a query, run as several smaller
+        queries at once, each for one partition of the items:
+
+        >>> server.issues.scan('project', status_id='*')
+        >>> server.time_entries.scan('spent_on', partitions=[
+        ...     (date(2013, 1, 1), date(2013, 6, 30)),
+        ...     (date(2013, 7, 1), date(2013, 12, 31))])
+
+        partition_by is a field the server filters by (see where), or 'id'.
+        Projects and trackers are partitioned by each of their values unless
+        partitions are given, other fields need the partitions: values, or
+        (first, last) ranges.  Up to workers partitions (the Redmine default
+        if not given) are fetched at once.  Items are returned as they
+        arrive, each only once.'''
+        if not self._query_path:
+            raise AttributeError('query is not available for %s' % self._item_name)
+        parameter, values = self._partitions(partition_by, partitions, options)
+        workers = workers or self._redmine.workers
+        return self._scan(parameter, values, workers, options)
+
+    def _partitions(self, partition_by, partitions, options):
+        '''Returns the query filter and its value for each partition.'''
+        query_filters = self._object._query_filters
+        if partition_by == 'id':
+            parameter = self._object._batch_filter
+        else:
+            parameter = query_filters.get(partition_by)
+        if not parameter:
+            raise ValueError("%s can't be partitioned by %s."
+                             % (self._item_name, partition_by))
+        if parameter in options:
+            raise ValueError('%s is already filtered by the query.' % parameter)
+
+        if partitions is None:
+            if partition_by == 'project':
+                partitions = [project.id for project in self._redmine.projects]
+                # Each issue only in its own project's partition
+                if 'subproject' in query_filters:
+                    options.setdefault(query_filters['subproject'], '!*')
+            elif partition_by == 'tracker':
+                partitions = [tracker.id for tracker in
+                              self._redmine.enumerations.items('tracker')]
+            else:
+                raise ValueError('Partitions by %s must be given.' % partition_by)
+
+        values = []
+        for partition in partitions:
+            if isinstance(partition, tuple):
+                condition = Field_Condition(partition_by, '><', partition)
+                values.append(condition._filter_value())
+            else:
+                values.append(_filter_text(partition))
+        return parameter, values
+
+    def _scan(self, parameter, values, workers, options):
+        '''Runs a query for each value of the partition filter in up to
+        workers threads, and yields the items as pages arrive.'''
+        pending = Queue.Queue()
+        for value in values:
+            pending.put(value)
+        # A few pages may wait for the caller, no more
+        arrived = Queue.Queue(maxsize=workers * 2)
+        stop = threading.Event()
+        done = object()
+
+        def deliver(entry):
+            while not stop.is_set():
+                try:
+                    arrived.put(entry, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    continue
+            return False
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    value = pending.get_nowait()
+                except Queue.Empty:
+                    break
+                partition = dict(options)
+                partition[parameter] = value
+                try:
+                    for data_container in self._pages(partition):
+                        if not deliver((data_container, None)):
+                            return
+                except Exception, e:
+                    deliver((None, e))
+                    return
+            deliver((done, None))
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(max(1, min(workers, len(values))))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        seen = set()
+        running = len(threads)
+        try:
+            while running:
+                data_container, error = arrived.get()
+                if error is not None:
+                    raise error
+                if data_container is done:
+                    running -= 1
+                    continue
+                for item in self._page_items(data_container):
+                    # Partitions may overlap, such as subprojects
+                    if item.id not in seen:
+                        seen.add(item.id)
+                        yield item
+        finally:
+            # Let the threads go if the caller stops early
+            stop.set()
+
+class _Spill_File(object):
+    '''Item data kept in a temporary file, one JSON line per item, which is
+    memory mapped once written so any item can be read back directly.'''
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        # Where each item's line starts, and the end of the last one
+        self._offsets = array('l', [0])
+        self._map = None
+        # The id of each item
+        self.ids = []
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def append(self, data):
+        line = json.dumps(data, separators=(',', ':')) + '\n'
+        self._file.write(line)
+        self._offsets.append(self._offsets[-1] + len(line))
+        self.ids.append(data.get('id'))
+
+    def finish(self):
+        '''Done writing, map the file for reading.'''
+        self._file.flush()
+        if len(self):
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+
+    def __getitem__(self, position):
+        '''Returns the data of the item at the given position.'''
+        start, end = self._offsets[position], self._offsets[position + 1]
+        return json.loads(self._map[start:end])
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+class Spilled_List(object):
+    '''The results of query_to_list(spill_threshold=...).
+    The first items are kept as they are, the others are made from the
+    data on disk each time they are accessed.'''
+
+    def __init__(self, manager, items, spill):
+        self._manager = manager
+        self._items = items
+        self._spill = spill
+
+    def __len__(self):
+        if self._spill is None:
+            return len(self._items)
+        return len(self._items) + len(self._spill)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position]
+                    for position in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('list index out of range')
+        if index < len(self._items):
+            return self._items[index]
+        data = self._spill[index - len(self._items)]
+        return self._manager._spilled_item(data)
+
+    def __iter__(self):
+        for position in xrange(len(self)):
+            yield self[position]
+
+    def close(self):
+        '''Remove the data on disk, only the first items remain.'''
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+
+class Spilled_Dict(object):
+    '''The results of query_to_dict(spill_threshold=...), by id.
+    The first items are kept as they are, the others are made from the
+    data on disk each time they are accessed.'''
+
+    def __init__(self, manager, items, spill):
+        self._list = Spilled_List(manager, items, spill)
+        # id -> position in the list
+        self._positions = {}
+        for position, item in enumerate(items):
+            self._positions[item.id] = position
+        for position, id in enumerate(spill.ids):
+            self._positions[id] = len(items) + position
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, id):
+        return id in self._positions
+
+    def __getitem__(self, id):
+        return self._list[self._positions[id]]
+
+    def get(self, id, default=None):
+        try:
+            return self[id]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def keys(self):
+        return self._positions.keys()
+
+    def iterkeys(self):
+        return iter(self._positions)
+
+    def itervalues(self):
+        for id in self._positions:
+            yield self[id]
+
+    def iteritems(self):
+        for id in self._positions:
+            yield id, self[id]
+
+    def close(self):
+        '''Remove the data on disk.'''
+        self._list.close()
+        self._positions = dict((item.id, position) for position, item
+                               in enumerate(self._list._items))
+
+
+# Write_Behind_Queues that are still open, closed when Python exits
+_open_queues = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_queues():
+    for queue in list(_open_queues):
+        queue.close()
+
+
+class Write_Behind_Queue(object):
+    '''Creates items in the background so callers don't wait on the server.
+
+    >>> log = server.time_entries.write_behind()
+    >>> log.put(issue_id=1, hours=0.25, activity='Development')
+
+    put returns right away.  A background thread takes whatever is waiting,
+    up to batch_size records at a time, and creates them with up to workers
+    requests at once.  flush waits for everything put so far to be sent,
+    and close (also run when Python exits) flushes and stops the thread.
+
+    Records that couldn't be created are kept in failed as (record, error)
+    pairs, and passed to on_error if it is given.  metrics() reports the
+    queue depth and how long records waited before being created.'''
+
+    # Put on the queue to stop the background thread
+    _stop = object()
+
+    def __init__(self, manager, workers=None, batch_size=20, max_size=0,
+                 on_error=None):
+        self._manager = manager
+        self.workers = workers or manager._redmine.workers
+        self.batch_size = batch_size
+        self.on_error = on_error
+        self.failed = []
+        self.closed = False
+
+        self._lock = threading.Lock()
+        # Held while checking closed and queueing, so nothing is put after
+        # the stop marker
+        self._put_lock = threading.Lock()
+        self.submitted = 0
+        self.created = 0
+        self._total_latency = 0.0
+        self.max_latency = 0.0
+
+        # A max_size makes put wait when the server can't keep up
+        self._queue = Queue.Queue(max_size)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        _open_queues.add(self)
+
+    def put(self, **record):
+        '''Queue up a new item with the given data.'''
+        with self._put_lock:
+            if self.closed:
+                raise RedmineError('The write behind queue has been closed.')
+            with self._lock:
+                self.submitted += 1
+            self._queue.put((record, time.time()))
+
+    @property
+    def depth(self):
+        '''The number of records waiting to be sent.'''
+        return self._queue.qsize()
+
+    def metrics(self):
+        '''Returns a dict of the queue depth, counts and latencies (in seconds).'''
+        with self._lock:
+            done = self.created + len(self.failed)
+            return {
+                'depth': self.depth,
+                'submitted': self.submitted,
+                'created': self.created,
+                'failed': len(self.failed),
+                'average_latency': done and self._total_latency / done,
+                'max_latency': self.max_latency,
+            }
+
+    def flush(self):
+        '''Wait until every record put so far has been sent.'''
+        self._queue.join()
+
+    def close(self):
+        '''Send everything still waiting, then stop the background thread.'''
+        with self._put_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._queue.put(self._stop)
+        self._thread.join()
+        _open_queues.discard(self)
+
+    def _next_batch(self):
+        '''Wait for a record, then grab any others already waiting.'''
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not self._stop:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        running = True
+        while running:
+            batch = self._next_batch()
+            if batch[-1] is self._stop:
+                running = False
+                batch.pop()
+                self._queue.task_done()
+
+            results = run_concurrently(lambda (record, queued):
+                                       self._manager.new(**record),
+                                       batch, self.workers)
+            finished = time.time()
+            with self._lock:
+                for (record, queued), (item, error) in zip(batch, results):
+                    latency = finished - queued
+                    self._total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                    if error is None:
+                        self.created += 1
+                    else:
+                        self.failed.append((record, error))
+            if self.on_error:
+                for (record, queued), (item, error) in zip(batch, results):
+                    if error is not None:
+                        try:
+                            self.on_error(record, error)
+                        except Exception:
+                            # Must not stop the thread, or flush would wait
+                            # forever; the record is in failed anyway
+                            pass
+            for entry in batch:
+                self._queue.task_done()
+
+
+class Unit_Of_Work(object):
+    '''Saves many changed items together, several at a time.
+
+    >>> work = server.unit_of_work()
+    >>> work.add(issue1, issue2)
+    >>> for item, error in work.commit():
+    ...     if error:
+    ...         print item, error
+
+    If no items are added, every item in the cache with unsaved changes is
+    saved.  It can also be used as a context manager, committing at the end
+    of the block if no exception was raised:
+
+    >>> with server.unit_of_work():
+    ...     issue1.subject = 'Foo'
+    ...     issue2.subject = 'Bar'
+
+    A failure to save one item doesn't stop the others.  After commit, the
+    saved and failed attributes list the items that were and weren't saved
+    (failed holds (item, error) pairs).'''
+
+    def __init__(self, redmine, workers=None):
+        self._redmine = redmine
+        self.workers = workers or redmine.workers
+        self._items = []
+        self.saved = []
+        self.failed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.commit()
+
+    def add(self, *items):
+        '''Add items to be saved on commit.'''
+        self._items.extend(items)
+
+    def commit(self):
+        '''Save the items, returns a list of (item, error) pairs where the
+        error is None for each item saved.'''
+        # Same item added twice should only be saved once, in the order added
+        seen = set()
+        items = []
+        for item in self._items or self._redmine.dirty_items():
+            if id(item) not in seen and item._is_dirty():
+                seen.add(id(item))
+                items.append(item)
+
+        results = run_concurrently(lambda item: item.save(), items,
+                                   self.workers)
+        results = [(item, error) for item, (saved, error)
+                   in zip(items, results)]
+        self.saved = [item for item, error in results if error is None]
+        self.failed = [(item, error) for item, error in results
+                       if error is not None]
+        self._items = []
+        return results
+
+
+class Redmine_Enumerations(object):
+    '''Reference tables of the enumerated values on a Redmine server.
+
+    Issue statuses, priorities, trackers and time entry activities are
+    loaded once (concurrently) the first time any of them is needed, and
+    then provide constant time lookups in both directions:
+
+    >>> server.enumerations.id('status', 'Closed')
+    5
+    >>> server.enumerations.name('status', 5)
+    u'Closed'
+
+    Issue categories belong to a project, so they are loaded per project:
+
+    >>> server.enumerations.id('category', 'Backend', project=proj)
+
+    A table that can't be loaded isn't kept: looking anything up in it
+    raises the error from the server, and the next lookup tries again.
+
+    The tags are the same ones used on the items themselves
+    (issue.status, issue.priority, time_entry.activity, etc).
+    '''
+
+    # Maps an item field to the server manager listing its values
+    _tables = {
+        'status': 'issue_statuses',
+        'priority': 'issue_priorities',
+        'tracker': 'trackers',
+        'activity': 'time_entry_activities',
+    }
+
+    def __init__(self, redmine):
+        self._redmine = redmine
+        self._lock = threading.Lock()
+        # tag (or ('category', project id)) -> (by id, by lower case name)
+        self._loaded = {}
+        # Why each table that couldn't be loaded failed
+        self.errors = {}
+
+    def _fetch(self, key):
+        '''Query the server for a table, returns (by id, by name) dicts.'''
+        if isinstance(key, tuple):
+            # ('category', project id)
+            item_class = self._redmine.item_class['issue_category']
+            manager = Redmine_Items_Manager(
+                self._redmine, item_class,
+                query_path='/projects/%s/issue_categories.json' % key[1])
+        else:
+            manager = getattr(self._redmine, self._tables[key])
+
+        by_id = {}
+        by_name = {}
+        for item in manager.query(limit=100):
+            by_id[item.id] = item
+            by_name[item.name.lower()] = item
+        return by_id, by_name
+
+    def load(self, *keys):
+        '''Load the given tables (all of them if none are given) from the server.
+        Tables that were already loaded are not fetched again.'''
+        keys = keys or self._tables.keys()
+        with self._lock:
+            missing = [key for key in keys if key not in self._loaded]
+            results = run_concurrently(self._fetch, missing,
+                                       self._redmine.workers)
+            for key, (table, error) in zip(missing, results):
+                if error:
+                    # Not kept, so it is tried again the next time it's needed
+                    self.errors[key] = error
+                    continue
+                self.errors.pop(key, None)
+                self._loaded[key] = table
+
+    def reload(self):
+        '''Forget everything loaded so far, it will be fetched again when needed.'''
+        with self._lock:
+            self._loaded = {}
+            self.errors = {}
+
+    def _table(self, tag, project=None, fetch=True):
+        if tag == 'category':
+            if project is None:
+                raise KeyError('Categories can only be found for a project.')
+            key = ('category', _index_key(project))
+        elif tag in self._tables:
+            key = tag
+        else:
+            raise KeyError('%s is not an enumerated value.' % tag)
+
+        try:
+            return self._loaded[key]
+        except KeyError:
+            if not fetch:
+                raise KeyError('%s is not loaded.' % tag)
+            # Grab all the global tables at once, they're small
+            if not isinstance(key, tuple):
+                self.load()
+            else:
+                self.load(key)
+        try:
+            return self._loaded[key]
+        except KeyError:
+            # It couldn't be loaded, say why
+            raise self.errors[key]
+
+    def get(self, tag, key, project=None, fetch=True):
+        '''Return the item for the given tag with the given id or name.
+        Without fetch, only tables already loaded are looked in.'''
+        by_id, by_name = self._table(tag, project, fetch)
+        try:
+            return by_id[key]
+        except KeyError:
+            pass
+        try:
+            return by_name[key.lower()]
+        except AttributeError:
+            raise KeyError('%s %r is not known.' % (tag, key))
+        except KeyError:
+            raise KeyError('%s %r is not known.' % (tag, key))
+
+    def items(self, tag, project=None):
+        '''Return all the items for the given tag.'''
+        return self._table(tag, project)[0].values()
+
+    def id(self, tag, name, project=None):
+        '''Return the id of the given tag with the given name.'''
+        return self.get(tag, name, project).id
+
+    def name(self, tag, id, project=None, fetch=True):
+        '''Return the name of the given tag with the given id,
+        or None if it isn't known (or not loaded, without fetch).'''
+        try:
+            return self.get(tag, id, project, fetch).name
+        except KeyError:
+            return None
+
+
 class Redmine_WS(object):
     '''Base class to handle all the Redmine lower-level interactions.'''
 
-    def __init__(self, url, key=None, username=None, password=None, debug=False, readonlytest=False, version=0.0, impersonate=None ):
+    def __init__(self, url, key=None, username=None, password=None, debug=False, readonlytest=False, version=0.0, impersonate=None, workers=4, compact=False ):
         self._url = url
         self._key = key
         self.debug = debug
         self.readonlytest = readonlytest
+        # How many requests can be run at once when that's helpful
+        self.workers = workers
+        # Use the __slots__ version of the item classes to save memory
+        self.compact = compact
         self.item_cache = {}
+        self._references = {}
+        # type -> {field: Cache_Index}, see add_index
+        self._indexes = {}
+        # Types whose every item is cached, see mark_replica_current
+        self._replicas = set()
+        self._cache_lock = threading.RLock()
+        # How many requests were skipped because they wouldn't change anything
+        self.requests_avoided = 0
         self._set_version(version)
         self.impersonate = impersonate
         if readonlytest:
@@ -617,6 +3080,8 @@ class Redmine_WS(object):
 
         self._setup_authentication(username, password)
         self.find_all_item_classes()
+        self.enumerations = Redmine_Enumerations(self)
+        self.custom_field_definitions = Custom_Field_Definitions()
 
     # extend the request to handle PUT command
     class PUT_Request(urllib2.Request):
@@ -660,7 +3125,7 @@ class Redmine_WS(object):
         # Install the opener.
         urllib2.install_opener( self._opener )
 
-    def open_raw(self, page, parms=None, payload=None, HTTPrequest=None, payload_type='application/json' ):
+    def open_raw(self, page, parms=None, payload=None, HTTPrequest=None, payload_type='application/json', headers=None ):
         '''Opens a page from the server with optional XML.  Returns a response file-like object'''
         if not parms:
             parms={}
@@ -703,6 +3168,11 @@ class Redmine_WS(object):
         if self.impersonate and self.impersonation_supported:
             request.add_header('X-Redmine-Switch-User', self.impersonate)
 
+        # Any other headers, such as If-None-Match
+        if headers:
+            for name, value in headers.iteritems():
+                request.add_header(name, value)
+
         # get the data and return XML object
         if payload:
             request.add_header('Content-Type', payload_type)
@@ -722,6 +3192,22 @@ class Redmine_WS(object):
         '''Gets an XML object from the server - used to read Redmine items.'''
         return self.open( page, parms )
 
+    def get_if_modified(self, page, etag=None, parms=None):
+        '''Gets a page unless it still matches the given ETag.
+        Returns (data, etag), where data is None if the page hasn't changed.'''
+        headers = {'If-None-Match': etag} if etag else None
+        try:
+            response = self.open_raw(page, parms, headers=headers)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return None, etag
+            raise
+        try:
+            etag = response.info().getheader('ETag')
+        except AttributeError:
+            etag = None
+        return response.read(), etag
+
     def post(self, page, payload, parms=None ):
         '''Posts a string payload to the server - used to make new Redmine items.  Returns an JSON string or error.'''
         if self.readonlytest:
@@ -745,6 +3231,110 @@ class Redmine_WS(object):
             return self.open( page, HTTPrequest=self.DELETE_Request )
 
 
+    def fetch_items(self, type, ids, workers=None):
+        '''Fetch the items of the given type and ids again.
+        Items with a _batch_filter are fetched 100 at a time in queries,
+        others are fetched one by one with up to workers requests at once.
+        A query only gives the same summary as any other, so partial items
+        fetched that way stay partial.
+        Returns a dict of {id: error} for those that couldn't be fetched.'''
+        ids = sorted(ids)
+        try:
+            item_class = self.item_class[type]
+        except KeyError:
+            return dict((id, KeyError('No item class for %s.' % type))
+                        for id in ids)
+        manager = Redmine_Items_Manager(self, item_class)
+        errors = {}
+
+        if item_class._batch_filter and manager._query_path:
+            for start in range(0, len(ids), 100):
+                chunk = ids[start:start + 100]
+                options = dict(item_class._batch_options, limit=100)
+                options[item_class._batch_filter] = ','.join(map(str, chunk))
+                found = set()
+                fetched_at = time.time()
+                for item in manager.query(**options):
+                    object.__setattr__(item, '_fetched_at', fetched_at)
+                    found.add(item.id)
+                for id in chunk:
+                    if id not in found:
+                        errors[id] = KeyError('%s %r not on server.'
+                                              % (item_class.__name__, id))
+            return errors
+
+        results = run_concurrently(manager.get, ids,
+                                   workers or self.workers)
+        for id, (item, error) in zip(ids, results):
+            if error is not None:
+                errors[id] = error
+        return errors
+
+    def add_index(self, type, field):
+        '''Index the cached items of the given type by the given field,
+        so they can be found without going through every cached item.
+        Returns the Cache_Index.'''
+        with self._cache_lock:
+            indexes = self._indexes.setdefault(type, {})
+            try:
+                return indexes[field]
+            except KeyError:
+                pass
+            index = indexes[field] = Cache_Index(field)
+            for id, item in self.item_cache.get(type, {}).iteritems():
+                index.update(id, item._peek(field))
+            return index
+
+    def mark_replica_current(self, type, current=True):
+        '''Declare that the cache holds every item of the given type, as
+        they are on the server (such as after syncing them all), or not.
+        While it does, queries of that type are answered from the cache
+        when they can be (see Redmine_Items_Manager.query).'''
+        with self._cache_lock:
+            if current:
+                self._replicas.add(type)
+            else:
+                self._replicas.discard(type)
+
+    def forget(self, type, id):
+        '''Drop an item from the cache and its indexes.'''
+        with self._cache_lock:
+            self.item_cache.get(type, {}).pop(id, None)
+            for index in self._indexes.get(type, {}).itervalues():
+                index.remove(id)
+
+    def revalidate(self, type, max_age=0, workers=None):
+        '''Fetch again the cached items of the given type that were read
+        more than max_age seconds ago (or never in full), as fetch_items does,
+        so items with a _batch_filter cost one request per 100 items (and
+        partial ones stay partial).
+        Items with unsaved changes are left alone.
+        Returns a dict of {id: error} for those that couldn't be fetched,
+        such as items deleted from the server.'''
+        now = time.time()
+        with self._cache_lock:
+            stale = [id for id, item in self.item_cache.get(type, {}).iteritems()
+                     if not item._is_dirty() and
+                     (item._fetched_at is None or now - item._fetched_at >= max_age)]
+        if not stale:
+            return {}
+        return self.fetch_items(type, stale, workers)
+
+    def dirty_items(self):
+        '''Returns all cached items that have unsaved changes.'''
+        with self._cache_lock:
+            return [item for items in self.item_cache.itervalues()
+                    for item in items.itervalues() if item._is_dirty()]
+
+    def unit_of_work(self, workers=None):
+        '''Returns a Unit_Of_Work to save many changed items at once.'''
+        return Unit_Of_Work(self, workers)
+
+    def count_avoided_request(self):
+        '''Note that a request to the server wasn't needed.'''
+        with self._cache_lock:
+            self.requests_avoided += 1
+
     def add(self, item):
         '''Add a Redmine_Item to this instance of Redmine.'''
         raise NotImplemented('so sorry')
@@ -782,8 +3372,9 @@ class Redmine_WS(object):
                 continue
         self.item_class = item_class
 
-    def check_cache(self, type, data, obj=None):
-        '''Returns the updated cached version of the given dict'''
+    def check_cache(self, type, data, obj=None, partial=False):
+        '''Returns the updated cached version of the given dict.
+        If partial, a new item is marked as only having some of its data.'''
         try:
             id = data['id']
         except:
@@ -797,23 +3388,49 @@ class Redmine_WS(object):
         except:
             pass
 
+        # Queries may be running in several threads at once
+        with self._cache_lock:
+            return self._check_cache(type, id, data, obj, partial)
+
+    def _check_cache(self, type, id, data, obj, partial=False):
+        # Just a reference to another item ({'id': 1, 'name': 'New'}) ?
+        is_reference = _reference_keys.issuperset(data)
+
         # Find the item in the cache, update and return if it's there
         try:
             hit = self.item_cache[type][id]
         except KeyError:
             pass
         else:
-            hit._update_data(data)
+            # References rarely have anything new to say
+            if not (is_reference and
+                    data.get('name', _missing) in (_missing, hit._peek('name', _missing))):
+                if hit._partial:
+                    object.__setattr__(hit, '_known_fields',
+                                       hit._schema.field_set(
+                                           data, hit._known_fields))
+                hit._update_data(data)
             #print 'cache hit for %s at %s' % (type, id)
             return hit
 
+        # References to items without a class of their own are shared flyweights
+        if is_reference and not obj and type not in self.item_class:
+            return self._reference(type, id, data.get('name'))
+
         # Not there? Let's make us a new item
         # If we weren't given the object ref, find the name in the global scope
         if not obj:
             # Default to Redmine_Item if it's not found
             obj = self.item_class.get(type, Redmine_Item)
+        if self.compact:
+            obj = compact_class(obj)
 
+        # Read first, custom fields are taken out of the data
+        known = obj._schema.field_set(data)
         new_item = obj(redmine=self, data=data, type=type)
+        if is_reference or partial:
+            object.__setattr__(new_item, '_partial', True)
+            object.__setattr__(new_item, '_known_fields', known)
 
         # Store it
         self.item_cache.setdefault(type, {})[id] = new_item
@@ -821,6 +3438,20 @@ class Redmine_WS(object):
 
         return new_item
 
+    def _reference(self, type, id, name=None):
+        '''Returns the shared Redmine_Reference for the given type and id.'''
+        key = (type, id)
+        try:
+            reference = self._references[key]
+        except KeyError:
+            pass
+        else:
+            if name is None or name == reference.name:
+                return reference
+        # New, or renamed: items already holding the old one keep it
+        reference = self._references[key] = Redmine_Reference(type, id, name)
+        return reference
+
 
 
 
@@ -487,6 +487,7 @@ setup(
     name = "pyredmine",
     packages = ["redmine"],
     install_requires = ["python-dateutil"],
+    extras_require = {"numpy": ["numpy"]},
     version = "0.2.4",
     description = "Python Redmine Web Services Library",
     long_description = readme(),
@@ -4,9 +4,19 @@ Perform various unit tests.
 from unittest import TestCase
 from mock import Mock
 from StringIO import StringIO
+from urllib2 import HTTPError
+from datetime import datetime, date
+from dateutil.tz import tzutc
 import json
+import time
+import os
+import shutil
+import tempfile
 
-from redmine import Redmine
+from redmine import Redmine, Bulk_Create_Error, RedmineConflictError, Field
+from redmine.redmine_rest import RedmineError
+from redmine.redmine import Issue
+from redmine.export import Exporter
 
 
 HTTP_MOCK_DATA = {}
@@ -29,6 +39,15 @@ HTTP_MOCK_DATA['/issues/1.json'] = \
         'project': 1,
     })
 
+# Issue with dates
+HTTP_MOCK_DATA['/issues/3.json'] = \
+    json.dumps({
+        'id': 3,
+        'subject': 'Dated',
+        'created_on': '2013-02-07T01:00:28Z',
+        'due_date': '2013-03-01',
+    })
+
 # All issues in project 1
 HTTP_MOCK_DATA['/projects/1/issues.json'] = \
     json.dumps({
@@ -72,12 +91,94 @@ HTTP_MOCK_DATA['/projects/1/issues.json?status_id=closed&tracker_id=1'] = \
 HTTP_MOCK_DATA['/projects/1/issues.json?tracker_id=1&status_id=closed'] = \
     HTTP_MOCK_DATA['/projects/1/issues.json?status_id=closed&tracker_id=1']
 
+# Assigned issues
+HTTP_MOCK_DATA['/issues.json?assigned_to_id=*'] = \
+    json.dumps({
+        'issues': [
+            {'id': issue_id,
+             'subject': 'Assigned %s' % issue_id,
+             'assigned_to': {'id': user_id, 'name': 'User %s' % user_id}}
+            for issue_id, user_id in ((11, 5), (12, 6), (13, 5))
+        ],
+        'total_count': 3,
+    })
+for user_id in (5, 6):
+    HTTP_MOCK_DATA['/users/%s.json' % user_id] = \
+        json.dumps({'user': {
+            'id': user_id,
+            'login': 'user%s' % user_id,
+            'mail': 'user%s@example.com' % user_id,
+        }})
+HTTP_MOCK_DATA['/users.json'] = \
+    json.dumps({
+        'users': [{'id': user_id, 'login': 'user%s' % user_id,
+                   'firstname': None}
+                  for user_id in (5, 6)],
+        'total_count': 2,
+    })
+
+# Issue with related data
+HTTP_MOCK_DATA['/issues/20.json?include=journals,children,relations,' +
+               'attachments,watchers'] = \
+    json.dumps({'issue': {
+        'id': 20,
+        'subject': 'Parent',
+        'updated_on': '2013-02-07T01:00:28Z',
+        'journals': [{'id': 1, 'notes': 'First'}],
+        'children': [{'id': 21, 'subject': 'Child',
+                      'tracker': {'id': 1, 'name': 'Bug'}}],
+        'relations': [{'id': 7, 'issue_id': 20, 'issue_to_id': 22,
+                       'relation_type': 'relates'}],
+        'attachments': [{'id': 9, 'filename': 'log.txt',
+                         'author': {'id': 5, 'name': 'User 5'},
+                         'created_on': '2013-02-07T01:00:28Z'}],
+        'watchers': [{'id': 5, 'name': 'User 5'}],
+    }})
+
+# Enumerations
+HTTP_MOCK_DATA['/issue_statuses.json'] = \
+    json.dumps({
+        'issue_statuses': [
+            {'id': 1, 'name': 'New', 'is_default': True},
+            {'id': 3, 'name': 'Resolved'},
+            {'id': 5, 'name': 'Closed', 'is_closed': True},
+        ]
+    })
+HTTP_MOCK_DATA['/trackers.json'] = \
+    json.dumps({
+        'trackers': [
+            {'id': 1, 'name': 'Bug'},
+            {'id': 2, 'name': 'Feature'},
+        ]
+    })
+HTTP_MOCK_DATA['/enumerations/issue_priorities.json'] = \
+    json.dumps({
+        'issue_priorities': [
+            {'id': 4, 'name': 'Low'},
+            {'id': 5, 'name': 'Normal', 'is_default': True},
+        ]
+    })
+HTTP_MOCK_DATA['/enumerations/time_entry_activities.json'] = \
+    json.dumps({
+        'time_entry_activities': [
+            {'id': 8, 'name': 'Design'},
+            {'id': 9, 'name': 'Development'},
+        ]
+    })
+HTTP_MOCK_DATA['/projects/1/issue_categories.json'] = \
+    json.dumps({
+        'issue_categories': [
+            {'id': 4, 'name': 'Backend', 'project': {'id': 1}},
+        ]
+    })
+
 
 def mock_open_raw(page,
                   parms=None,
                   payload=None,
                   HTTPrequest=None,
-                  payload_type='application/json'):
+                  payload_type='application/json',
+                  headers=None):
     '''
     Pretends to be the URL open method on the Redmine WS class.
     '''
@@ -139,6 +240,22 @@ class TestProjectsAndIssues(TestCase):
         # Verify that the update data from project1 reference came in
         assert issue1.subject == 'Updated'
 
+    def test_project_managers(self):
+        '''
+        Test that the project sub-managers are made when first used.
+        '''
+        project1 = self.test_redmine.projects[1]
+        assert 'issues' not in vars(project1)
+        issues = project1.issues
+        assert issues._query_path == '/projects/1/issues.json'
+        assert project1.issues is issues
+        assert project1.wiki_pages is not None
+
+        redm = Redmine('null', version=1.0)
+        redm.open_raw = Mock(side_effect=mock_open_raw)
+        assert not hasattr(redm.projects[1], 'members')
+        assert not hasattr(redm.projects[1], 'wiki_pages')
+
     def test_get_closed_issues(self):
         '''
         Test getting closed issues, and other custom queries
@@ -282,3 +399,1102 @@ class TestVersionBehavior(TestCase):
         assert redm.time_entry_activities is not None
         assert redm.has_project_memberships is True
         assert redm.has_wiki_pages is True
+
+
+class TestEnumerations(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+
+    def test_lookups(self):
+        '''
+        Test name and id lookups of enumerated values.
+        '''
+        enumerations = self.test_redmine.enumerations
+        assert enumerations.id('status', 'Closed') == 5
+        assert enumerations.id('status', 'closed') == 5
+        assert enumerations.name('status', 3) == 'Resolved'
+        assert enumerations.name('status', 99) is None
+        assert enumerations.id('tracker', 'Feature') == 2
+        assert enumerations.id('priority', 'Normal') == 5
+        assert enumerations.id('activity', 'Design') == 8
+        self.assertRaises(KeyError, enumerations.id, 'status', 'Nope')
+
+        # Everything is loaded once
+        calls = self.test_redmine.open_raw.call_count
+        enumerations.id('tracker', 'Bug')
+        assert self.test_redmine.open_raw.call_count == calls
+
+    def test_remap_names(self):
+        '''
+        Test that names are sent to the server as ids.
+        '''
+        issue = self.test_redmine.issues[1]
+        issue.tracker = 'Feature'
+        issue.set_status('Closed')
+        payload = json.loads(self.test_redmine.open_raw.call_args[0][2])
+        assert payload['issue']['status_id'] == 5
+        assert payload['issue']['tracker_id'] == 2
+        assert issue.status.name == 'Closed'
+
+    def test_close_names_status(self):
+        '''
+        Test closing an issue shows the status name once statuses are loaded,
+        and that an id alone doesn't load them.
+        '''
+        issue = self.test_redmine.issues[1]
+        issue.set_status(3)
+        pages = [call[0][0] for call in self.test_redmine.open_raw.call_args_list]
+        assert '/issue_statuses.json' not in pages
+
+        self.test_redmine.enumerations.load()
+        issue.close()
+        payload = json.loads(self.test_redmine.open_raw.call_args[0][2])
+        assert payload['issue']['status_id'] == 5
+        assert issue.status.name == 'Closed'
+
+    def test_category_name(self):
+        '''
+        Test that a category name is found in the issue's project.
+        '''
+        issue = self.test_redmine.issues[1]
+        issue.category = 'Backend'
+        issue.save()
+        payload = json.loads(self.test_redmine.open_raw.call_args[0][2])
+        assert payload['issue']['category_id'] == 4
+
+    def test_failed_table_retried(self):
+        '''
+        Test that a table that failed to load is fetched again.
+        '''
+        def failing_trackers(page, *args, **kwargs):
+            if page == '/trackers.json':
+                raise HTTPError(page, 500, 'Server Error', {}, None)
+            return mock_open_raw(page, *args, **kwargs)
+        self.test_redmine.open_raw.side_effect = failing_trackers
+        enumerations = self.test_redmine.enumerations
+        self.assertRaises(HTTPError, enumerations.id, 'tracker', 'Feature')
+        assert enumerations.id('status', 'Closed') == 5
+        assert 'tracker' in enumerations.errors
+
+        self.test_redmine.open_raw.side_effect = mock_open_raw
+        assert enumerations.id('tracker', 'Feature') == 2
+        assert 'tracker' not in enumerations.errors
+
+
+class TestCompactItems(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none", compact=True)
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+
+    def test_compact_issue(self):
+        '''
+        Test that compact items behave like the normal ones.
+        '''
+        issue = self.test_redmine.issues[1]
+        assert isinstance(issue, Issue)
+        assert type(issue).__slots__
+        assert issue.subject == 'Problem with foo'
+        assert issue.due_date is None
+        assert issue._changes is None
+        self.assertRaises(AttributeError, setattr, issue, 'id', 5)
+
+        issue.subject = 'Changed'
+        assert issue._changes == {'subject': 'Changed'}
+        issue.save()
+        payload = json.loads(self.test_redmine.open_raw.call_args[0][2])
+        assert payload == {'issue': {'subject': 'Changed'}}
+        assert not issue._changes
+
+
+class TestDates(TestCase):
+    def check_dates(self, test_redmine):
+        issue = test_redmine.issues[3]
+        # Not parsed until read
+        assert not isinstance(vars(issue).get('created_on'), datetime)
+        assert issue.created_on == datetime(2013, 2, 7, 1, 0, 28,
+                                            tzinfo=tzutc())
+        assert issue.due_date == datetime(2013, 3, 1)
+        assert issue.start_date is None
+
+        issue.due_date = datetime(2013, 4, 1)
+        issue.save()
+        payload = json.loads(test_redmine.open_raw.call_args[0][2])
+        assert payload == {'issue': {'due_date': '2013-04-01'}}
+
+    def test_dates(self):
+        '''
+        Test that date fields are parsed when read.
+        '''
+        test_redmine = Redmine("http://no-route.none")
+        test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+        self.check_dates(test_redmine)
+
+    def test_compact_dates(self):
+        '''
+        Test date fields on compact items.
+        '''
+        test_redmine = Redmine("http://no-route.none", compact=True)
+        test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+        self.check_dates(test_redmine)
+
+
+class TestJournals(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+
+    def tearDown(self):
+        HTTP_MOCK_DATA.pop('/issues/4.json?include=journals', None)
+
+    def set_journals(self, updated_on, count):
+        HTTP_MOCK_DATA['/issues/4.json?include=journals'] = \
+            json.dumps({'issue': {
+                'id': 4,
+                'subject': 'Discussed',
+                'updated_on': updated_on,
+                'journals': [{'id': id, 'notes': 'Note %s' % id}
+                             for id in range(1, count + 1)],
+            }})
+
+    def test_journals_cached(self):
+        '''
+        Test that journals are only fetched again after an update.
+        '''
+        self.set_journals('2013-02-07T01:00:28Z', 2)
+        issue = self.test_redmine.issues.get(4, parms={'include': 'journals'})
+        first = issue.journals
+        assert [journal.notes for journal in first] == ['Note 1', 'Note 2']
+
+        calls = self.test_redmine.open_raw.call_count
+        assert issue.journals == first
+        assert self.test_redmine.open_raw.call_count == calls
+
+        # The issue was updated on the server
+        self.set_journals('2013-02-08T01:00:28Z', 3)
+        self.test_redmine.check_cache('issue', {
+            'id': 4, 'updated_on': '2013-02-08T01:00:28Z'})
+        journals = issue.journals
+        assert self.test_redmine.open_raw.call_count == calls + 1
+        assert len(journals) == 3
+        assert journals[0] is first[0]
+
+    def test_journal_errors(self):
+        '''
+        Test that problems getting the journals are not hidden.
+        '''
+        issue = self.test_redmine.issues[1]
+        self.assertRaises(KeyError, lambda: issue.journals)
+
+
+class TestSchema(TestCase):
+    def test_encode(self):
+        '''
+        Test converting changes to what the server expects.
+        '''
+        assert 'created_on' in Issue._schema.protected
+        changes = {'due_date': datetime(2013, 4, 1),
+                   'project': {'id': 3, 'name': 'Test 3'},
+                   'subject': 'Same'}
+        Issue._schema.encode(changes)
+        assert changes == {'due_date': '2013-04-01',
+                           'project_id': 3,
+                           'subject': 'Same'}
+
+
+class TestUnchangedSaves(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+
+    def test_no_op_save(self):
+        '''
+        Test that saving values the server already has sends nothing.
+        '''
+        issue = self.test_redmine.issues.get(1)
+        self.test_redmine.check_cache('issue', {
+            'id': 1, 'status': {'id': 5, 'name': 'Closed'}})
+        self.test_redmine.enumerations.load()
+        calls = self.test_redmine.open_raw.call_count
+
+        issue.set_status(5)
+        issue.subject = 'Something else'
+        issue.subject = 'Problem with foo'
+        issue.save()
+        assert self.test_redmine.open_raw.call_count == calls
+        assert self.test_redmine.requests_avoided == 2
+        assert not issue._changes
+
+        # A real change is still sent, without the unchanged fields
+        issue.subject = 'Something else'
+        issue.status = {'id': 5}
+        issue.save()
+        assert self.test_redmine.open_raw.call_count == calls + 1
+        payload = json.loads(self.test_redmine.open_raw.call_args[0][2])
+        assert payload == {'issue': {'subject': 'Something else'}}
+
+
+class TestUnitOfWork(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+
+    def test_commit(self):
+        '''
+        Test saving every changed item at once.
+        '''
+        issue1 = self.test_redmine.issues[1]
+        issue3 = self.test_redmine.issues[3]
+        tracker = self.test_redmine.check_cache('tracker',
+                                                {'id': 1, 'name': 'Bug'})
+        issue1.subject = 'One'
+        issue3.subject = 'Three'
+        tracker.description = 'Cannot be saved'
+
+        with self.test_redmine.unit_of_work() as work:
+            pass
+        assert sorted(item.id for item in work.saved) == [1, 3]
+        assert [item for item, error in work.failed] == [tracker]
+        assert isinstance(work.failed[0][1], AttributeError)
+        assert not issue1._is_dirty()
+        assert self.test_redmine.dirty_items() == [tracker]
+
+    def test_commit_order(self):
+        '''
+        Test items are saved and reported once each, in the order added.
+        '''
+        issue1 = self.test_redmine.issues[1]
+        issue3 = self.test_redmine.issues[3]
+        issue1.subject = 'One'
+        issue3.subject = 'Three'
+        work = self.test_redmine.unit_of_work(workers=1)
+        work.add(issue3, issue1, issue3)
+        results = work.commit()
+        assert [item for item, error in results] == [issue3, issue1]
+        assert work.saved == [issue3, issue1]
+
+
+class TestNewMany(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=self.mock_post)
+        self.posted = []
+
+    def mock_post(self, page, parms=None, payload=None, HTTPrequest=None,
+                  payload_type='application/json'):
+        '''
+        Pretends to create time entries, refusing any with negative hours.
+        '''
+        entry = json.loads(payload)['time_entry']
+        if entry['hours'] < 0:
+            raise ValueError('Bad hours')
+        self.posted.append(entry['hours'])
+        entry['id'] = entry['hours'] * 10
+        return StringIO(json.dumps({'time_entry': entry}))
+
+    def test_new_many(self):
+        '''
+        Test creating many items, and resuming after a failure.
+        '''
+        records = [{'hours': hours, 'issue': {'id': 1}}
+                   for hours in range(1, 21)]
+        records[12]['hours'] = -1
+        try:
+            self.test_redmine.time_entries.new_many(records, chunk_size=5)
+        except Bulk_Create_Error, e:
+            assert e.errors.keys() == [12]
+            assert [entry.id for entry in e.created] == \
+                [hours * 10 for hours in range(1, 13) + range(14, 16)]
+            checkpoint = e.checkpoint
+        else:
+            self.fail('Bulk_Create_Error not raised')
+        assert checkpoint == {'position': 15, 'failed': [12]}
+
+        records[12]['hours'] = 13
+        del self.posted[:]
+        entries = self.test_redmine.time_entries.new_many(
+            records, checkpoint=checkpoint, chunk_size=5)
+        assert sorted(self.posted) == [13] + range(16, 21)
+        assert [entry.id for entry in entries] == \
+            [130] + [hours * 10 for hours in range(16, 21)]
+        assert entries[0].issue_id == 1
+
+    def test_resume_failing_again(self):
+        '''
+        Test that failed records not reached on resume are kept.
+        '''
+        records = [{'hours': hours} for hours in range(1, 7)]
+        records[1]['hours'] = -1
+        try:
+            self.test_redmine.time_entries.new_many(
+                records, checkpoint={'position': 4, 'failed': [1, 3]},
+                chunk_size=1)
+        except Bulk_Create_Error, e:
+            assert e.errors.keys() == [1]
+            assert e.checkpoint == {'position': 4, 'failed': [1, 3]}
+        else:
+            self.fail('Bulk_Create_Error not raised')
+        assert self.posted == []
+
+    def test_write_behind(self):
+        '''
+        Test creating items in the background.
+        '''
+        errors = []
+        log = self.test_redmine.time_entries.write_behind(
+            batch_size=3, on_error=lambda record, error: errors.append(record))
+        assert self.test_redmine.time_entries.write_behind() is log
+        self.assertRaises(ValueError, self.test_redmine.time_entries.write_behind,
+                          batch_size=5)
+        for hours in range(1, 11):
+            log.put(hours=hours)
+        log.put(hours=-1)
+        log.flush()
+        metrics = log.metrics()
+        assert metrics['depth'] == 0
+        assert metrics['submitted'] == 11
+        assert metrics['created'] == 10
+        assert metrics['failed'] == 1
+        assert metrics['max_latency'] >= metrics['average_latency'] > 0
+        assert errors == [{'hours': -1}]
+        assert sorted(self.posted) == range(1, 11)
+
+        log.put(hours=11)
+        log.close()
+        assert log.created == 11
+        self.assertRaises(RedmineError, log.put, hours=12)
+        assert self.test_redmine.time_entries.write_behind() is not log
+        self.test_redmine.time_entries.write_behind().close()
+
+    def test_write_behind_bad_handler(self):
+        '''
+        Test that an on_error handler raising doesn't stop the queue.
+        '''
+        def on_error(record, error):
+            raise KeyError(record['hours'])
+        log = self.test_redmine.time_entries.write_behind(on_error=on_error)
+        log.put(hours=-1)
+        log.flush()
+        log.put(hours=1)
+        log.close()
+        assert log.created == 1
+        assert len(log.failed) == 1
+
+
+class TestCustomFields(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+
+    def test_custom_fields(self):
+        '''
+        Test custom fields sharing their definitions between items.
+        '''
+        issues = [self.test_redmine.check_cache('issue', {
+            'id': id,
+            'custom_fields': [{'id': 4, 'name': 'The Client', 'value': 'Bob'},
+                              {'id': 7, 'name': 'Inform', 'value': '0'}],
+        }) for id in (1, 3)]
+        assert issues[0].custom_fields._layout is \
+            issues[1].custom_fields._layout
+        assert issues[0]['The Client'] == 'Bob'
+        assert issues[0].custom_fields[7] == '0'
+        self.assertRaises(KeyError, lambda: issues[0]['Nope'])
+
+        issues[0]['Inform'] = '1'
+        issues[0]['The Client'] = 'John Cleese'
+        issues[0]['The Client'] = 'Bob'
+        issues[0].save()
+        payload = json.loads(self.test_redmine.open_raw.call_args[0][2])
+        assert payload == {'issue': {'custom_field_values': {'7': '1'}}}
+        assert not issues[0]._is_dirty()
+        assert issues[0]['Inform'] == '1'
+
+
+class TestSharedReferences(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+
+    def test_references(self):
+        '''
+        Test that references to the same item are shared.
+        '''
+        issues = [self.test_redmine.check_cache('issue', {
+            'id': id,
+            'status': {'id': 1, 'name': 'New'},
+            'priority': {'id': 4, 'name': 'Low'},
+            'tracker': {'id': 1, 'name': 'Bug'},
+        }) for id in (1, 3)]
+        assert issues[0].status is issues[1].status
+        assert issues[0].priority is issues[1].priority
+        assert issues[0].tracker is issues[1].tracker
+        status = issues[0].status
+        assert status.name == 'New'
+        assert status['id'] == 1
+        assert int(status) == 1
+        assert repr(status) == '<Redmine status #1 - New>'
+        self.assertRaises(AttributeError, setattr, status, 'name', 'Old')
+
+    def test_roles(self):
+        '''
+        Test that membership roles are shared.
+        '''
+        memberships = [self.test_redmine.check_cache('membership', {
+            'id': id,
+            'roles': [{'id': 3, 'name': 'Manager'}],
+        }) for id in (1, 2)]
+        assert memberships[0].roles[0] is memberships[1].roles[0]
+        assert memberships[0].roles[0].name == 'Manager'
+        assert not memberships[0]._is_dirty()
+
+
+class TestPrefetch(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+
+    def test_prefetch_related(self):
+        '''
+        Test fetching the users issues refer to, once each.
+        '''
+        query = self.test_redmine.issues(assigned_to_id='*',
+                                         prefetch_related=['assigned_to'])
+        issue = query.next()
+        # All users of the page were fetched before the first issue
+        users = [call[0][0] for call in
+                 self.test_redmine.open_raw.call_args_list
+                 if call[0][0].startswith('/users/')]
+        assert sorted(users) == ['/users/5.json', '/users/6.json']
+        assert issue.assigned_to.mail == 'user5@example.com'
+        assert not issue.assigned_to._partial
+
+        issues = [issue] + list(query)
+        assert issues[0].assigned_to is issues[2].assigned_to
+        assert issues[1].assigned_to.login == 'user6'
+
+
+class TestFaultIn(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+
+    def test_fault_in(self):
+        '''
+        Test reading a field missing from a query fetches the whole page once.
+        '''
+        users = list(self.test_redmine.users())
+        assert all(user._partial for user in users)
+        assert users[0].login == 'user5'
+        assert self.test_redmine.open_raw.call_count == 1
+
+        assert users[0].mail == 'user5@example.com'
+        assert self.test_redmine.open_raw.call_count == 3
+        assert users[1].mail == 'user6@example.com'
+        assert users[1].lastname is None
+        assert self.test_redmine.open_raw.call_count == 3
+
+    def test_failed_fetch(self):
+        '''
+        Test a field reads as missing when the details can't be fetched.
+        '''
+        user = self.test_redmine.check_cache('user', {'id': 77, 'name': 'Gone'})
+        assert user._partial
+        assert user.mail is None
+        assert self.test_redmine.open_raw.call_count == 1
+        assert user.lastname is None
+        assert self.test_redmine.open_raw.call_count == 1
+
+    def test_no_needless_fetch(self):
+        '''
+        Test that printing, fields sent as null and included data don't fetch.
+        '''
+        users = list(self.test_redmine.users())
+        assert repr(users[0]) == '<Redmine user #5>'
+        assert str(users[0]) == '<Redmine user #5, "None None">'
+        assert users[0].firstname is None
+        assert self.test_redmine.open_raw.call_count == 1
+
+        issues = list(self.test_redmine.issues(assigned_to_id='*'))
+        assert str(issues[0]) == '<Redmine issue #11, "Assigned 11">'
+        assert getattr(issues[0], 'children', None) is None
+        assert getattr(issues[0], 'watchers', None) is None
+        assert self.test_redmine.open_raw.call_count == 2
+        assert issues[0]._partial
+
+
+class TestRevalidation(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.server = {'subject': 'Dated', 'updated_on': '2013-02-07T01:00:28Z'}
+        self.test_redmine.open_raw = Mock(side_effect=self.mock_open_raw)
+        self.test_redmine.put = Mock(side_effect=self.mock_put)
+
+    def mock_put(self, page, payload):
+        '''
+        Saves issue 3, which moves its updated_on on.
+        '''
+        self.server.update(json.loads(payload)['issue'])
+        self.server['updated_on'] = '2013-02-07T02:00:00Z'
+
+    def mock_open_raw(self, page, parms=None, payload=None, HTTPrequest=None,
+                      payload_type='application/json', headers=None):
+        '''
+        Serves issue 3 with an ETag made from its data.
+        '''
+        data = json.dumps({'issue': dict(self.server, id=3)}, sort_keys=True)
+        etag = '"%x"' % hash(data)
+        if headers and headers.get('If-None-Match') == etag:
+            raise HTTPError(page, 304, 'Not Modified', {}, None)
+        response = StringIO(data)
+        response.info = Mock(return_value=Mock(getheader=Mock(return_value=etag)))
+        return response
+
+    def test_refresh(self):
+        '''
+        Test refreshing an unchanged item is cheap, and doesn't save.
+        '''
+        issue = self.test_redmine.issues[3]
+        issue.refresh()
+        assert self.test_redmine.open_raw.call_count == 2
+        issue.subject = 'Local'
+        self.server['subject'] = 'Remote'
+        issue.refresh()
+        assert issue.subject == 'Local'
+        assert issue._changes == {'subject': 'Local'}
+        assert not self.test_redmine.put.called
+        # Unchanged since the last refresh
+        issue.refresh()
+        assert self.test_redmine.open_raw.call_count == 4
+        issue.refresh(max_age=60)
+        assert self.test_redmine.open_raw.call_count == 4
+        assert self.test_redmine.requests_avoided == 1
+
+    def test_refresh_custom_fields(self):
+        '''
+        Test unsaved custom field changes are kept on top of refreshed data.
+        '''
+        self.server['custom_fields'] = [
+            {'id': 4, 'name': 'Client', 'value': 'Bob'},
+            {'id': 7, 'name': 'Inform', 'value': '0'}]
+        issue = self.test_redmine.issues[3]
+        issue['Client'] = 'Alice'
+        self.server['custom_fields'][1]['value'] = '1'
+        issue.refresh()
+        assert issue['Client'] == 'Alice'
+        assert issue['Inform'] == '1'
+        issue.save()
+        assert self.server['custom_field_values'] == {'4': 'Alice'}
+
+    def test_conflict(self):
+        '''
+        Test a save is refused when the item changed on the server.
+        '''
+        issue = self.test_redmine.issues[3]
+        issue.subject = 'Mine'
+        issue.save(check_conflicts=True)
+        # Our own save isn't a conflict
+        issue.subject = 'Mine again'
+        issue.save(check_conflicts=True)
+        assert self.test_redmine.put.call_count == 2
+
+        issue.refresh()
+        assert issue.updated_on == datetime(2013, 2, 7, 2, 0, tzinfo=tzutc())
+        self.server['updated_on'] = '2013-02-08T01:00:28Z'
+        issue.subject = 'Mine once more'
+        try:
+            issue.save(check_conflicts=True)
+        except RedmineConflictError, e:
+            assert e.item is issue
+            assert e.server_data['updated_on'] == '2013-02-08T01:00:28Z'
+        else:
+            self.fail('RedmineConflictError not raised')
+        assert self.test_redmine.put.call_count == 2
+        assert issue._changes == {'subject': 'Mine once more'}
+
+
+class TestRevalidateSweep(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=self.mock_open_raw)
+
+    def mock_open_raw(self, page, parms=None, payload=None, HTTPrequest=None,
+                      payload_type='application/json', headers=None):
+        '''
+        Serves any issues asked for by id, except deleted issue 104.
+        '''
+        assert page == '/issues.json'
+        ids = [int(id) for id in parms['issue_id'].split(',')
+               if id != '104']
+        return StringIO(json.dumps({
+            'issues': [{'id': id, 'subject': 'Fresh %s' % id} for id in ids],
+            'total_count': len(ids),
+        }))
+
+    def test_revalidate(self):
+        '''
+        Test stale cached issues are fetched 100 at a time.
+        '''
+        redmine = self.test_redmine
+        for issue_id in range(1, 151):
+            redmine.check_cache('issue', {'id': issue_id, 'subject': 'Old'},
+                                partial=True)
+        redmine.item_cache['issue'][1]._fetched_at = time.time()
+        redmine.item_cache['issue'][2].subject = 'Unsaved'
+
+        assert not redmine.item_cache['issue'][1]._is_dirty()
+
+        errors = redmine.revalidate('issue', max_age=60)
+        assert redmine.open_raw.call_count == 2
+        assert errors.keys() == [104]
+        # Issue 1 was fresh, issue 2 has unsaved changes
+        asked = set()
+        for call in redmine.open_raw.call_args_list:
+            asked.update(int(id) for id in call[0][1]['issue_id'].split(','))
+        assert asked == set(range(3, 151))
+        assert redmine.item_cache['issue'][1].subject == 'Old'
+        assert redmine.item_cache['issue'][2].subject == 'Unsaved'
+        assert redmine.item_cache['issue'][150].subject == 'Fresh 150'
+        # Queries only have a summary
+        assert redmine.item_cache['issue'][150]._partial
+
+        # All fresh now
+        errors = redmine.revalidate('issue', max_age=60)
+        assert redmine.open_raw.call_count == 3
+        assert errors.keys() == [104]
+
+
+class TestCacheIndexes(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.put = Mock()
+
+    def test_indexes(self):
+        '''
+        Test finding cached issues through an index kept up to date.
+        '''
+        redmine = self.test_redmine
+        for issue_id, user_id in ((1, 5), (2, 6), (3, 5)):
+            redmine.check_cache('issue', {
+                'id': issue_id, 'subject': 'Issue %s' % issue_id,
+                'assigned_to': {'id': user_id, 'name': 'User %s' % user_id}})
+        index = redmine.issues.add_index('assigned_to')
+        assert index.ids(5) == set([1, 3])
+        assert [issue.id for issue in redmine.issues.cached(assigned_to=5)] \
+            == [1, 3]
+
+        # New data from the server
+        redmine.check_cache('issue', {'id': 3, 'assigned_to': {'id': 6}})
+        redmine.check_cache('issue', {'id': 4, 'assigned_to': {'id': 5}})
+        assert index.ids(5) == set([1, 4])
+
+        # Saved changes
+        issue = redmine.item_cache['issue'][1]
+        issue.assigned_to_id = 6
+        issue.save()
+        assert [issue.id for issue in
+                redmine.issues.cached(assigned_to_id=6)] == [1, 2, 3]
+        assert [issue.id for issue in redmine.issues.cached(
+                assigned_to=redmine.item_cache['user'][6],
+                subject='Issue 2')] == [2]
+        assert redmine.item_cache['issue'][1].assigned_to is \
+            redmine.item_cache['user'][6]
+
+        # Unindexed fields agree with the server too
+        closed = redmine.item_cache['issue'][1]
+        closed.status_id = 5
+        closed.save()
+        assert closed.status.id == 5
+        assert [item.id for item in redmine.issues.cached(status=5)] == [1]
+        assert [item.id for item in redmine.issues.cached(status_id=5)] == [1]
+
+
+class TestLocalReplica(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+        self.test_redmine.enumerations.load()
+        self.test_redmine.open_raw.reset_mock()
+
+    def test_local_queries(self):
+        '''
+        Test queries are answered from a current replica.
+        '''
+        redmine = self.test_redmine
+        redmine.check_cache('project', {'id': 1, 'identifier': 'top'})
+        redmine.check_cache('project', {'id': 2, 'parent': {'id': 1}})
+        for issue_id, project_id, status_id, user_id, value in (
+                (1, 1, 1, 5, 'a'), (2, 2, 1, 6, 'b'), (3, 1, 5, 5, 'a'),
+                (4, 2, 3, 7, 'c')):
+            redmine.check_cache('issue', {
+                'id': issue_id,
+                'project': {'id': project_id},
+                'status': {'id': status_id},
+                'assigned_to': {'id': user_id},
+                'custom_fields': [{'id': 2, 'name': 'Kind', 'value': value}]})
+        redmine.mark_replica_current('issue')
+        redmine.mark_replica_current('project')
+
+        def ids(**options):
+            return [issue.id for issue in redmine.issues(**options)]
+        assert ids() == [4, 2, 1]
+        assert ids(status_id='closed') == [3]
+        assert ids(status_id='*', assigned_to_id='5|7') == [4, 3, 1]
+        assert ids(status_id='!1') == [4, 3]
+        assert ids(cf_2='a', status_id='*') == [3, 1]
+        assert ids(project_id='top', subproject_id='!*') == [1]
+        project = redmine.item_cache['project'][1]
+        assert [issue.id for issue in project.issues(status_id='*')] == \
+            [4, 3, 2, 1]
+        assert redmine.open_raw.call_count == 0
+
+        # Left to the server
+        assert redmine.issues._local_query({'sort': 'id'}) is None
+        assert redmine.issues._local_query({'assigned_to_id': 'me'}) is None
+        redmine.mark_replica_current('project', False)
+        assert redmine.issues._local_query({'project_id': 1}) is None
+
+
+class TestWhere(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=self.mock_open_raw)
+
+    def mock_open_raw(self, page, parms=None, payload=None, HTTPrequest=None,
+                      payload_type='application/json', headers=None):
+        '''
+        Serves the same three issues for any query.
+        '''
+        return StringIO(json.dumps({
+            'issues': [
+                {'id': 1, 'subject': 'Fix it', 'due_date': '2013-02-01',
+                 'custom_fields': [{'id': 2, 'value': 'x'}]},
+                {'id': 2, 'subject': 'Urgent fix', 'due_date': '2013-03-01',
+                 'custom_fields': [{'id': 2, 'value': 'y'}]},
+                {'id': 3, 'subject': 'Urgent', 'due_date': '2013-04-01',
+                 'custom_fields': [{'id': 2, 'value': 'y'}]},
+            ],
+            'total_count': 3,
+        }))
+
+    def test_pushdown(self):
+        '''
+        Test conditions the server can check become query filters.
+        '''
+        status = Field('status')
+        due = Field('due_date')
+        issues = self.test_redmine.issues.where(
+            (status == 1) | (status == 3),
+            Field('tracker') != 2,
+            due >= date(2013, 2, 1), due <= '2013-03-15',
+            Field('cf_4').is_set(),
+            lambda issue: 'Urgent' in issue.subject)
+        # Only the function was left to check here
+        assert [issue.id for issue in issues] == [2, 3]
+        parms = self.test_redmine.open_raw.call_args[0][1]
+        assert parms['status_id'] == '1|3'
+        assert parms['tracker_id'] == '!2'
+        assert parms['due_date'] == '><2013-02-01|2013-03-15'
+        assert parms['cf_4'] == '*'
+
+    def test_client_side(self):
+        '''
+        Test conditions the server can't check are checked on each item.
+        '''
+        issues = self.test_redmine.issues.where(
+            Field('due_date') > datetime(2013, 2, 1, tzinfo=tzutc()),
+            ~(Field('subject').contains('fix')),
+            Field('cf_2') == 'y', status_id='*')
+        assert [issue.id for issue in issues] == [3]
+        parms = self.test_redmine.open_raw.call_args[0][1]
+        assert parms['status_id'] == '*'
+        assert parms['cf_2'] == 'y'
+
+    def test_unsupported_operators(self):
+        '''
+        Test operators the server lacks for a field are checked here,
+        and that nothing is asked for when nothing can match.
+        '''
+        issues = self.test_redmine.issues.where(
+            Field('subject') >= 'Urgent', Field('done_ratio') <= 50)
+        assert [issue.id for issue in issues] == [2, 3]
+        parms = self.test_redmine.open_raw.call_args[0][1]
+        assert 'subject' not in parms
+        assert parms['done_ratio'] == '<=50'
+
+        # None of the mock issues has a tracker
+        assert list(self.test_redmine.issues.where(Field('tracker') >= 2)) == []
+        parms = self.test_redmine.open_raw.call_args[0][1]
+        assert 'tracker_id' not in parms
+
+        calls = self.test_redmine.open_raw.call_count
+        assert list(self.test_redmine.issues.where(
+            Field('assigned_to').is_in([]))) == []
+        assert self.test_redmine.open_raw.call_count == calls
+
+
+def mock_issue_pages(page, parms=None, payload=None, HTTPrequest=None,
+                     payload_type='application/json', headers=None):
+    '''
+    Serves issues 1 to 7, with issue 4 in both trackers.
+    '''
+    tracker = parms.get('tracker_id')
+    ids = {None: range(1, 8), '1': [1, 2, 3, 4], '2': [4, 5, 6, 7]}[tracker]
+    offset = parms['offset']
+    return StringIO(json.dumps({
+        'issues': [{'id': id, 'subject': 'Issue %s' % id}
+                   for id in ids[offset:offset + parms['limit']]],
+        'total_count': len(ids),
+    }))
+
+
+class TestScans(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_issue_pages)
+
+    def test_parallel_pages(self):
+        '''
+        Test pages after the first are fetched together, in order.
+        '''
+        issues = list(self.test_redmine.issues(limit=2, workers=3))
+        assert [issue.id for issue in issues] == range(1, 8)
+        assert self.test_redmine.open_raw.call_count == 4
+
+    def test_scan(self):
+        '''
+        Test a scan by partitions returns every item once.
+        '''
+        issues = self.test_redmine.issues.scan('tracker', partitions=[1, 2],
+                                               limit=2)
+        assert sorted(issue.id for issue in issues) == range(1, 8)
+        trackers = set(call[0][1]['tracker_id'] for call in
+                       self.test_redmine.open_raw.call_args_list)
+        assert trackers == set(['1', '2'])
+        try:
+            self.test_redmine.issues.scan('spent_on')
+        except ValueError:
+            pass
+        else:
+            self.fail('ValueError not raised')
+
+
+def mock_time_entry_pages(page, parms=None, payload=None, HTTPrequest=None,
+                          payload_type='application/json', headers=None):
+    '''
+    Serves five time entries, a page at a time.
+    '''
+    entries = [
+        {'id': 1, 'user': {'id': 5}, 'activity': {'id': 9}, 'hours': 1.5,
+         'spent_on': '2013-01-02'},
+        {'id': 2, 'user': {'id': 5}, 'activity': {'id': 9}, 'hours': 2.0,
+         'spent_on': '2013-01-03'},
+        {'id': 3, 'user': {'id': 6}, 'activity': {'id': 9}, 'hours': 0.5,
+         'spent_on': '2013-02-01'},
+        {'id': 4, 'user': {'id': 5}, 'activity': {'id': 8}, 'hours': 4.0,
+         'spent_on': '2013-02-01'},
+        {'id': 5, 'user': {'id': 6}, 'activity': {'id': 9},
+         'spent_on': '2013-02-05'},
+    ]
+    offset = parms['offset']
+    return StringIO(json.dumps({
+        'time_entries': entries[offset:offset + parms['limit']],
+        'total_count': len(entries),
+    }))
+
+
+class TestAggregate(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_time_entry_pages)
+
+    def test_aggregate(self):
+        '''
+        Test totals are made from the raw data, without caching items.
+        '''
+        time_entries = self.test_redmine.time_entries
+        totals = time_entries.aggregate(by=['user', 'activity'], sum='hours',
+                                        limit=2, workers=2)
+        assert totals == {(5, 9): 3.5, (6, 9): 0.5, (5, 8): 4.0}
+        months = time_entries.aggregate(
+            by=lambda entry: entry['spent_on'][:7], limit=2)
+        assert months == {'2013-01': 2, '2013-02': 3}
+        assert 'time_entry' not in self.test_redmine.item_cache
+
+
+class TestColumns(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_time_entry_pages)
+
+    def test_arrays(self):
+        '''
+        Test columns are made as arrays, without caching items.
+        '''
+        columns = self.test_redmine.time_entries.query_columns(
+            ['id', 'user', 'hours', 'spent_on'], as_numpy=False, limit=2)
+        assert columns['id'].tolist() == [1, 2, 3, 4, 5]
+        assert columns['user'].tolist() == [5, 5, 6, 5, 6]
+        assert columns['hours'].tolist()[:4] == [1.5, 2.0, 0.5, 4.0]
+        assert columns['hours'][4] != columns['hours'][4]
+        assert columns['spent_on'][0] == \
+            date(2013, 1, 2).toordinal() - date(1970, 1, 1).toordinal()
+        assert 'time_entry' not in self.test_redmine.item_cache
+
+    def test_numpy(self):
+        '''
+        Test columns are made as a NumPy structured array.
+        '''
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy not installed')
+        columns = self.test_redmine.time_entries.query_columns(
+            ['id', 'activity', 'hours', 'spent_on'], limit=2)
+        assert columns.dtype.names == ('id', 'activity', 'hours', 'spent_on')
+        assert columns['activity'].tolist() == [9, 9, 9, 8, 9]
+        assert numpy.nansum(columns['hours']) == 8.0
+        assert columns['spent_on'][2] == numpy.datetime64('2013-02-01')
+
+
+class TestExport(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=self.mock_open_raw)
+        self.directory = tempfile.mkdtemp()
+        self.fail_at = None
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def mock_open_raw(self, page, parms=None, payload=None, HTTPrequest=None,
+                      payload_type='application/json', headers=None):
+        '''
+        Serves issues 1 to 5 sorted by id, failing once at the given offset.
+        '''
+        assert parms['status_id'] == '*' and parms['sort'] == 'id'
+        offset = parms['offset']
+        if offset == self.fail_at:
+            self.fail_at = None
+            raise IOError('Connection reset')
+        return StringIO(json.dumps({
+            'issues': [{'id': id, 'subject': u'Issue \xe9 %s' % id,
+                        'status': {'id': 1, 'name': 'New'}}
+                       for id in range(1, 6)[offset:offset + parms['limit']]],
+            'total_count': 5,
+        }))
+
+    def test_resume(self):
+        '''
+        Test an interrupted export carries on from its checkpoint.
+        '''
+        self.fail_at = 4
+        exporter = Exporter(self.test_redmine, self.directory, limit=2)
+        self.assertRaises(IOError, exporter.run, 'issues')
+        exporter = Exporter(self.test_redmine, self.directory, limit=2)
+        assert exporter.run('issues') == {'issues': 5}
+        with open(os.path.join(self.directory, 'issues.jsonl')) as lines:
+            ids = [json.loads(line)['id'] for line in lines]
+        assert ids == [1, 2, 3, 4, 5]
+        offsets = [call[0][1]['offset'] for call in
+                   self.test_redmine.open_raw.call_args_list]
+        assert offsets == [0, 2, 4, 4]
+        assert 'issue' not in self.test_redmine.item_cache
+
+    def test_csv(self):
+        '''
+        Test exporting chosen fields as CSV.
+        '''
+        exporter = Exporter(self.test_redmine, self.directory, format='csv')
+        exporter.export('issues', fields=['id', 'subject', 'status'])
+        with open(os.path.join(self.directory, 'issues.csv')) as rows:
+            lines = rows.read().splitlines()
+        assert lines[0] == 'id,subject,status'
+        assert lines[1] == '1,Issue \xc3\xa9 1,1'
+        assert len(lines) == 6
+
+
+class TestSpill(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_issue_pages)
+
+    def test_spilled_list(self):
+        '''
+        Test items past the threshold are made from disk when accessed.
+        '''
+        issues = self.test_redmine.issues.query_to_list(spill_threshold=3,
+                                                        limit=2)
+        assert len(issues) == 7
+        assert sorted(self.test_redmine.item_cache['issue']) == [1, 2, 3]
+        assert issues[0] is self.test_redmine.item_cache['issue'][1]
+        assert issues[5].subject == 'Issue 6'
+        assert issues[-1].id == 7
+        assert [issue.id for issue in issues[2:5]] == [3, 4, 5]
+        assert [issue.id for issue in issues] == range(1, 8)
+        assert sorted(self.test_redmine.item_cache['issue']) == [1, 2, 3]
+        self.assertRaises(IndexError, issues.__getitem__, 7)
+        issues.close()
+        assert len(issues) == 3
+        self.assertRaises(IndexError, issues.__getitem__, 5)
+
+    def test_spill_options(self):
+        '''
+        Test spilled queries take the options query does, and leave the
+        cache indexes alone.
+        '''
+        redmine = self.test_redmine
+        index = redmine.issues.add_index('subject')
+        issues = redmine.issues.query_to_list(spill_threshold=3, limit=2,
+                                              include=['journals'])
+        assert redmine.open_raw.call_args[0][1]['include'] == 'journals'
+        assert issues[5].subject == 'Issue 6'
+        assert index.ids('Issue 6') == set()
+        assert index.ids('Issue 2') == set([2])
+
+        # Answered from the cache once it holds every issue
+        redmine.mark_replica_current('issue')
+        calls = redmine.open_raw.call_count
+        issues = redmine.issues.query_to_list(spill_threshold=1,
+                                              status_id='!*')
+        assert [issue.id for issue in issues] == [3, 2, 1]
+        assert redmine.open_raw.call_count == calls
+
+    def test_spilled_dict(self):
+        '''
+        Test spilled items can be looked up by id.
+        '''
+        issues = self.test_redmine.issues.query_to_dict(spill_threshold=3)
+        assert len(issues) == 7
+        assert 6 in issues and 8 not in issues
+        assert issues[6].subject == 'Issue 6'
+        assert sorted(issues.keys()) == range(1, 8)
+        assert issues.get(8) is None
+        issues.close()
+        assert sorted(issues) == [1, 2, 3]
+
+
+class TestInclude(TestCase):
+    def setUp(self):
+        self.test_redmine = Redmine("http://no-route.none")
+        self.test_redmine.open_raw = Mock(side_effect=mock_open_raw)
+
+    def test_get_include(self):
+        '''
+        Test getting an issue with its related data in one request.
+        '''
+        issue = self.test_redmine.issues.get(
+            20, include=['journals', 'children', 'relations',
+                         'attachments', 'watchers'])
+        assert self.test_redmine.open_raw.call_count == 1
+        assert [journal.notes for journal in issue.journals] == ['First']
+        child = issue.children[0]
+        assert isinstance(child, Issue)
+        assert child.subject == 'Child'
+        assert issue.relations[0].relation_type == 'relates'
+        assert issue.relations[0].issue_to_id == 22
+        attachment = issue.attachments[0]
+        assert attachment.filename == 'log.txt'
+        assert attachment.author is issue.watchers[0]
+        assert attachment.created_on.year == 2013
+        assert self.test_redmine.open_raw.call_count == 1